@@ -0,0 +1,205 @@
+'''In-memory aggregates of the compiled database.
+
+country_year_summary (see dbtools.py) is small: one row per country and year. Loaded
+into NumPy arrays of cumulative sums over the years, the totals of any year range are
+the difference of two columns, for all countries at once. The map metrics are computed
+this way instead of aggregating `publications` in SQLite on every slider move.
+
+Counts that also depend on a second key, like affiliations per partner country, are kept
+the same way in GroupedYearSums, storing only the pairs that occur. Rankings that cannot
+be summed, like the most cited articles, are merged from per-year lists (YearTopLists).
+'''
+
+import heapq
+import itertools
+import math
+
+import numpy as np
+
+import queries
+
+
+# majority_country of papers without a single majority country, never shown on the map
+MULTINATIONAL = 'Multinational'
+
+
+def sqlite_round(values, decimals):
+    '''ROUND(x, decimals) of SQLite for non-negative values. SQLite rounds half away from
+    zero the decimal digits of x, not its binary value, e.g. 9.575 (9.57499...) -> 9.58,
+    so the scaled values are taken with 15 significant digits first.'''
+    scale = 10 ** decimals
+    scaled = np.array([float(f'{x:.15g}') for x in (values * scale).tolist()])
+    return np.floor(scaled + 0.5) / scale
+
+
+class CountryYearSums:
+    '''Cumulative sums of the country_year_summary columns.
+
+    `cumsums[column][c, i]` is the sum of the column for country `countries[c]` over the
+    years before `first_year + i`, so the sum over [start, end] is
+    cumsums[:, end - first_year + 1] - cumsums[:, start - first_year].
+    '''
+
+    COLUMNS = ('n_papers', 'n_open_access', 'n_open_access_known', 'sum_authors', 'n_authors_known',
+               'sum_references', 'n_references_known', 'sum_citations')
+
+    def __init__(self, countries, first_year, cumsums):
+        self.countries = countries
+        self.first_year = first_year
+        self.n_years = next(iter(cumsums.values())).shape[1] - 1
+        self.cumsums = cumsums
+        self.index = {country: c for c, country in enumerate(countries)}
+        self.on_map = np.array([country != MULTINATIONAL for country in countries], dtype=bool)
+        self._names = np.array(countries, dtype=object)
+
+    @classmethod
+    def from_db(cls, conn):
+        rows = conn.execute(queries.COUNTRY_YEAR_SUMMARY).fetchall()
+        # sorted like GROUP BY majority_country
+        countries = sorted({row[0] for row in rows})
+        if rows:
+            first_year = min(row[1] for row in rows)
+            n_years = max(row[1] for row in rows) - first_year + 1
+        else:
+            first_year, n_years = 0, 0
+        index = {country: i for i, country in enumerate(countries)}
+        values = {column: np.zeros((len(countries), n_years + 1)) for column in cls.COLUMNS}
+        for country, year, *sums in rows:
+            for column, value in zip(cls.COLUMNS, sums):
+                # NULL sums (no known values) add nothing, like in SUM()
+                values[column][index[country], year - first_year + 1] = value or 0
+        cumsums = {column: np.cumsum(array, axis=1) for column, array in values.items()}
+        return cls(countries, first_year, cumsums)
+
+    def range_sums(self, year_range):
+        '''Sum of every column per country over the years in year_range (inclusive).'''
+        start = min(max(int(year_range[0]) - self.first_year, 0), self.n_years)
+        end = min(max(int(year_range[1]) - self.first_year + 1, start), self.n_years)
+        return {column: cumsum[:, end] - cumsum[:, start] for column, cumsum in self.cumsums.items()}
+
+    def total(self, country, year_range, column='n_papers'):
+        c = self.index.get(country)
+        if c is None:
+            return 0
+        start = min(max(int(year_range[0]) - self.first_year, 0), self.n_years)
+        end = min(max(int(year_range[1]) - self.first_year + 1, start), self.n_years)
+        return int(self.cumsums[column][c, end] - self.cumsums[column][c, start])
+
+    def map_ratio(self, year_range, min_papers, numerator, denominator, scale=1, decimals=2):
+        '''{country: ROUND(scale * numerator / denominator, decimals)} for the countries on the
+        map with at least min_papers papers in year_range, None where the denominator is 0.
+        Same as ROUND(AVG(...), decimals) ... HAVING COUNT(*) >= min_papers on `publications`.'''
+        sums = self.range_sums(year_range)
+        n_papers = sums['n_papers']
+        shown = self.on_map & (n_papers > 0) & (n_papers >= min_papers)
+        top, bottom = sums[numerator][shown], sums[denominator][shown]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = sqlite_round(top * scale / bottom, decimals)
+        return {country: None if math.isnan(value) else value
+                for country, value in zip(self._names[shown], ratio.tolist())}
+
+
+class GroupedYearSums:
+    '''Sparse cumulative per-year counts of items within groups, e.g. of the partner
+    countries (items) of each home country (groups).
+
+    Only (group, item) pairs that occur are stored. The pairs of group g are the rows
+    offsets[g]:offsets[g + 1] of `items` and `cumsums`, ordered by item name, and
+    cumsums[row, i] is the count over the years before `first_year + i`.
+    '''
+
+    def __init__(self, groups, item_names, offsets, items, first_year, cumsums):
+        self.groups = {group: g for g, group in enumerate(groups)}
+        self.item_names = item_names
+        self.offsets = offsets
+        self.items = items
+        self.first_year = first_year
+        self.n_years = cumsums.shape[1] - 1
+        self.cumsums = cumsums
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''rows of (group, item, year, count), at most one per (group, item, year)'''
+        rows = list(rows)
+        groups = sorted({row[0] for row in rows})
+        item_names = sorted({row[1] for row in rows})
+        group_index = {group: g for g, group in enumerate(groups)}
+        item_index = {item: i for i, item in enumerate(item_names)}
+        pairs = sorted({(group_index[group], item_index[item]) for group, item, _, _ in rows})
+        pair_index = {pair: p for p, pair in enumerate(pairs)}
+        if rows:
+            first_year = min(row[2] for row in rows)
+            n_years = max(row[2] for row in rows) - first_year + 1
+        else:
+            first_year, n_years = 0, 0
+
+        counts = np.zeros((len(pairs), n_years + 1), dtype=np.int64)
+        for group, item, year, count in rows:
+            counts[pair_index[group_index[group], item_index[item]], year - first_year + 1] = count
+        cumsums = np.cumsum(counts, axis=1)
+        # int32 halves the resident size and is plenty for counts of papers
+        if cumsums.size and cumsums.max() < np.iinfo(np.int32).max:
+            cumsums = cumsums.astype(np.int32)
+
+        pair_groups = np.array([g for g, _ in pairs], dtype=np.int64)
+        offsets = np.searchsorted(pair_groups, np.arange(len(groups) + 1))
+        items = np.array([i for _, i in pairs], dtype=np.int32)
+        return cls(groups, item_names, offsets, items, first_year, cumsums)
+
+    def range_counts(self, group, year_range):
+        '''(item ids, counts) of the group over the years in year_range (inclusive), for
+        the items with a non-zero count, ordered by item name.'''
+        g = self.groups.get(group)
+        if g is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        start = min(max(int(year_range[0]) - self.first_year, 0), self.n_years)
+        end = min(max(int(year_range[1]) - self.first_year + 1, start), self.n_years)
+        rows = slice(self.offsets[g], self.offsets[g + 1])
+        counts = self.cumsums[rows, end].astype(np.int64) - self.cumsums[rows, start]
+        nonzero = counts > 0
+        return self.items[rows][nonzero], counts[nonzero]
+
+    def top(self, group, year_range, n=None):
+        '''[(item, count)] of the n largest counts of the group in year_range (all if n is
+        None), the largest first and equal counts by item name. Only the counts at or
+        above the n-th largest are sorted.'''
+        items, counts = self.range_counts(group, year_range)
+        if n is not None and n < len(counts):
+            nth = np.partition(counts, len(counts) - n)[len(counts) - n]
+            items, counts = items[counts >= nth], counts[counts >= nth]
+        # a stable sort keeps the name order of equal counts
+        order = np.argsort(-counts, kind='stable')[:n]
+        return [(self.item_names[i], c) for i, c in zip(items[order].tolist(), counts[order].tolist())]
+
+    def ranking(self, group, year_range):
+        '''{item: count} of the group in year_range, ordered as in top'''
+        return dict(self.top(group, year_range))
+
+
+def citation_order(row):
+    # cit_per_year DESC (NULL last), then pmid, like the ORDER BY of dbtools.build_top_cited
+    return (row[1] is None, -(row[1] or 0), row[2])
+
+
+class YearTopLists:
+    '''Precomputed top rows per (country, year), merged on request into the top rows of
+    a year range. `depth` is the length of the stored lists, i.e. the largest k served.'''
+
+    def __init__(self, lists, depth):
+        self.lists = lists
+        self.depth = depth
+
+    @classmethod
+    def from_rows(cls, rows, depth):
+        '''rows of (country, year, title, citations, pmid) ordered by country, year and rank'''
+        lists = {}
+        for country, year, *row in rows:
+            lists.setdefault(country, {}).setdefault(year, []).append(tuple(row) + (year,))
+        return cls(lists, depth)
+
+    def top(self, country, year_range, k):
+        '''First k rows over the years in year_range: a k-way merge of the sorted
+        per-year lists.'''
+        years = self.lists.get(country, {})
+        per_year = [years[year] for year in range(int(year_range[0]), int(year_range[1]) + 1) if year in years]
+        return list(itertools.islice(heapq.merge(*per_year, key=citation_order), k))
@@ -1,47 +1,170 @@
-import pandas as pd
-import sqlite3
-import plotly.express as px
 import dash
-from dash import html, dcc
+from dash import html, dcc, ctx, no_update, Patch, ClientsideFunction
 import dash_leaflet as dl
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
-import json
-import matplotlib.cm as cm
-import matplotlib.colors as mcolors
+import hashlib
+import os
+import threading
+import time
+import uuid
+import numpy as np
+from flask import request, Response, abort, g
 #import dash_leaflet.express as dlx
 from dash_extensions.javascript import assign
-from collections import defaultdict, Counter
+# loaded by dash itself anyway
 import dash.dash_table as dash_table
+# pandas and plotly.express (~0.5 s to import) are imported where they are used, so
+# that a new worker serves its first page without them, see plotly_express
+from dbtools import TOP_CITED_DEPTH, check_database
+import queries
+from db import ConnectionPool, QueryCache, LatestRequests, CacheWarmer, SlowQueryLog, FetchPool
+from aggregates import CountryYearSums, GroupedYearSums, YearTopLists, sqlite_round
+from columnar import ColumnarSnapshot, snapshot_directory
+from build_maps import LEVELS, SOURCE, ENCODINGS, level_file
+import metrics
+from metrics import registry, record_timing, timed
 
 
 
 style_handle = assign("""
 function(feature, context){
+    const hideout = context.hideout || {};
+    const code = feature.properties.ISO_A2;
     // If a style for the country exists in the hideout, use it.
-    if (context.hideout && context.hideout.styles && context.hideout.styles[feature.properties.ISO_A2]) {
-        return context.hideout.styles[feature.properties.ISO_A2];
+    if (hideout.styles && hideout.styles[code]) {
+        return hideout.styles[code];
+    }
+    // Otherwise color raw values on the colorscale, the same 256-step table as get_colors on the server.
+    if (hideout.values && hideout.values[code] != null) {
+        const stops = hideout.colorscale;
+        const [vmin, vmax] = hideout.domain;
+        const t = vmax === vmin ? 0 : (hideout.values[code] - vmin) / (vmax - vmin);
+        const x = Math.min(Math.max(Math.floor(t * 256), 0), 255) / 255 * (stops.length - 1);
+        const i = Math.min(Math.floor(x), stops.length - 2);
+        const channel = (c, k) => parseInt(c.substr(1 + 2 * k, 2), 16);
+        let fill = '#';
+        for (let k = 0; k < 3; k++) {
+            const v = Math.round(channel(stops[i], k) + (x - i) * (channel(stops[i + 1], k) - channel(stops[i], k)));
+            fill += v.toString(16).padStart(2, '0');
+        }
+        return {fillColor: fill, fillOpacity: 0.8, color: 'black', weight: 1};
+    }
+    // Highlight the clicked country.
+    if (hideout.selected === code) {
+        return {fillColor: 'red', fillOpacity: 0.5, color: 'black', weight: 2.5};
     }
     // Otherwise, return a default style.
     return {color: 'black', weight: 1, fillOpacity: 0.05};
 }
 """)
+#########################################
+### CONNECT DB ###
+#########################################    
+
+
+# Path to the preloaded database
+DB_FILE = os.environ.get('NMR_DB_FILE', '/var/data/data.db')
+
+# Set NMR_DB_IMMUTABLE=1 when a refreshed database always replaces the file (see ConnectionPool)
+DB_IMMUTABLE = os.environ.get('NMR_DB_IMMUTABLE') == '1'
+
+# Statements slower than NMR_SLOW_QUERY_MS are written with their query plan to the
+# rotating JSON-lines file NMR_SLOW_QUERY_LOG ('{pid}' is replaced by the worker's pid)
+SLOW_QUERY_LOG = os.environ.get('NMR_SLOW_QUERY_LOG')
+SLOW_QUERY_SECONDS = float(os.environ.get('NMR_SLOW_QUERY_MS', 200)) / 1000
+
+# Extra threads per worker fetching the data of both plot panels side by side (see FetchPool)
+FETCH_THREADS = int(os.environ.get('NMR_FETCH_THREADS', 2))
+
+# Country outlines, one simplified copy per level of detail written by 'python build_maps.py'.
+# They are served by the /maps/ route below (not inlined in the layout), so each level
+# is kept as bytes for every available Content-Encoding, keyed by a hash of its content.
+def load_map_level(level):
+    path = level_file(level)
+    if not path.exists():
+        print(f'{path} not found, run: python build_maps.py (using full-precision outlines)')
+        path = SOURCE
+    variants = {'identity': path.read_bytes()}
+    for encoding, suffix in ENCODINGS.items():
+        compressed = path.with_name(path.name + suffix)
+        if compressed.exists():
+            variants[encoding] = compressed.read_bytes()
+    return dict(digest=hashlib.sha256(variants['identity']).hexdigest()[:16], variants=variants)
+
+map_levels = [load_map_level(level) for level in range(len(LEVELS))]
+
+# Newest callback request per browser session and output, older ones are dropped
+latest_requests = LatestRequests()
+
+# Time of every SQL statement, by the query helper running it, see /metrics
+SQL_SECONDS = registry.histogram('dashboard_sql_seconds',
+                                 'Time of SQL statements, from execute until their last row was fetched',
+                                 ['helper'])
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_LOG, SLOW_QUERY_SECONDS) if SLOW_QUERY_LOG else None
+
+def observe_statement(conn, statement):
+    SQL_SECONDS.observe(statement.seconds, helper=statement.helper or 'other')
+    record_timing('sql', statement.seconds)
+    if slow_query_log is not None:
+        slow_query_log(conn, statement)
+
+# Read-only connections, one per server thread; queries of dropped requests are aborted
+pool = ConnectionPool(DB_FILE, cancelled=latest_requests.cancelled, immutable=DB_IMMUTABLE,
+                      on_statement=observe_statement)
+
+# Time of every query helper result that is computed, i.e. not found in the cache, see /metrics
+QUERY_HELPER_SECONDS = registry.histogram('dashboard_query_helper_seconds',
+                                          'Time to compute a query helper result missing from the query cache',
+                                          ['helper'])
+
+def observe_query_helper(name, seconds):
+    QUERY_HELPER_SECONDS.observe(seconds, helper=name)
+    record_timing(f'helper.{name}', seconds)
+
+# Results of the query helpers, shared by the map and both plot panels
+query_cache = QueryCache(pool, on_compute=observe_query_helper)
+
+# Threads fetching independent data of one callback concurrently
+fetch_pool = FetchPool(FETCH_THREADS)
+
+# Nothing above opens the database. Plots read the tables and indexes maintained by
+# 'python dbtools.py compile', which check_database verifies once before serving
+# (in __main__ below, or in the gunicorn master, see gunicorn.conf.py). The gunicorn
+# master also builds the in-memory tables before forking, see load_tables.
+
+def load_tables():
+    # called in the gunicorn master before forking: the workers inherit the tables built
+    # from the whole database (copy-on-write) instead of each building its own copy
+    for table in (country_year_sums, co_affiliations, top_cited_lists, journal_counts, journal_titles):
+        table()
+    columnar_snapshot()
+    # the workers open connections of their own
+    pool.close()
+
+def after_fork(threads=None):
+    # called in every new gunicorn worker: connections, results and metrics are per process
+    pool.reset()
+    query_cache.clear()
+    query_cache.reset_counts()
+    metrics.reset_after_fork()
+    if threads:
+        WORKER_THREADS.set(threads)
+
 
 #########################################
 ### FUNCTIONS ###
 #########################################
 
 def best_collabs(x):
-    x = dict(sorted(x.items(), key=lambda item: item[1], reverse=True))
-    nmax = len(list(x.items()))
-    if nmax >= 5:
-        output = str(list(x.items())[0:5]).replace("'","").replace("[","").replace("]","").replace("]","")\
-                                                .replace("(","").replace(")","").replace(",",":")
-        return 'Most foreign affiliations: ' + output
-    elif nmax < 5 and nmax >= 1:
-        output = str(list(x.items())[0:nmax]).replace("'","").replace("[","").replace("]","").replace("]","")\
-                                                .replace("(","").replace(")","").replace(",",":")
+    # x is ranked already, see collaborators
+    top = list(x.items())[0:5]
+    if top:
+        output = str(top).replace("'","").replace("[","").replace("]","").replace("]","")\
+                         .replace("(","").replace(")","").replace(",",":")
         return 'Most foreign affiliations: ' + output
     else:
         return 'No foreign affiliations'
@@ -54,28 +177,52 @@ def empty_df_info():
                                         template='plotly_white',xaxis=dict(visible=False),yaxis=dict(visible=False)))
     
 
+def query_params(year_range, **params):
+    # values bound to the named parameters of the SQL in queries.py
+    return dict(year_start=int(year_range[0]), year_end=int(year_range[1]), **params)
+
+def columnar_snapshot():
+    # memory-mapped by every worker, None if 'python dbtools.py export-columns' was not run;
+    # opened again when it is exported after the database has been loaded
+    try:
+        exported = (snapshot_directory(DB_FILE) / 'meta.json').stat().st_mtime_ns
+    except FileNotFoundError:
+        exported = None
+    return open_columnar_snapshot(exported)
+
+@query_cache.memoize_per_db
+def open_columnar_snapshot(exported=None):
+    return ColumnarSnapshot.open(snapshot_directory(DB_FILE), pool.connection())
+
+def summary_ratio(numerator, denominator, decimals=None):
+    # ROUND(CAST(numerator AS FLOAT) / denominator, decimals) as in queries.py, NULL when nothing is known
+    if not denominator:
+        return None
+    ratio = numerator / denominator
+    return ratio if decimals is None else float(sqlite_round(np.array([ratio]), decimals)[0])
+
+def read_per_year(query, country_code, year_range, columns, row, ascending=False):
+    '''Rows of one of the per-year queries on country_year_summary. With a columnar snapshot
+    they are computed by row(YearSummary) from its mapped per-year sums instead of querying SQLite.'''
+    import pandas as pd
+    snapshot = columnar_snapshot()
+    if snapshot is None:
+        return pd.read_sql(query, pool.connection(), params=query_params(year_range, country=country_code))
+    summaries = snapshot.year_summaries(country_code, year_range)
+    rows = [row(s) for s in (summaries[::-1] if ascending else summaries)]
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+@query_cache.memoize
 def get_pubs_per_year_per_country(country_code, year_range):
-    query = "SELECT year_pubmed as Year, COUNT(*) as 'Articles' FROM publications\
-         WHERE majority_country = '{country}'\
-         AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-         GROUP BY year_pubmed\
-         ORDER BY year_pubmed DESC".format(country=country_code,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
-    pubs_per_year = pd.read_sql(query, conn)
+    pubs_per_year = read_per_year(queries.PUBS_PER_YEAR, country_code, year_range, ['Year', 'Articles'],
+                                  lambda s: (s.year, s.n_papers))
     return pubs_per_year
 
+@query_cache.memoize
 def openacces_per_year_per_country(country_code, year_range):
          
-    query = "SELECT year_pubmed as Year, ROUND(CAST(SUM(is_open_access) AS FLOAT)*100 / COUNT(is_open_access),1) as 'Open access' FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            GROUP BY year_pubmed\
-            ORDER BY year_pubmed DESC".format(country=country_code,
-                                        year_start=year_range[0],
-                                        year_end=year_range[1])    
-
-    oa_per_year = pd.read_sql(query, conn)
+    oa_per_year = read_per_year(queries.OPEN_ACCESS_PER_YEAR, country_code, year_range, ['Year', 'Open access'],
+                                lambda s: (s.year, summary_ratio(s.n_open_access * 100, s.n_open_access_known, 1)))
     if oa_per_year.empty:
         return oa_per_year
     else:
@@ -83,128 +230,101 @@ def openacces_per_year_per_country(country_code, year_range):
     
     return oa_per_year
 
+@query_cache.memoize
 def av_authors_per_year_per_country(country_code, year_range):
-    query = "SELECT year_pubmed as Year, ROUND(AVG(authors_number),2) as 'Average number of authors' FROM publications\
-         WHERE majority_country = '{country}'\
-         AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-         GROUP BY year_pubmed\
-         ORDER BY year_pubmed DESC".format(country=country_code,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
-    auth_per_year = pd.read_sql(query, conn)
+    auth_per_year = read_per_year(queries.AUTHORS_PER_YEAR, country_code, year_range,
+                                  ['Year', 'Average number of authors'],
+                                  lambda s: (s.year, summary_ratio(s.sum_authors, s.n_authors_known, 2)))
     return auth_per_year
 
+@query_cache.memoize
 def aacr_per_year_per_country(country_code, year_range):
-    query = "SELECT year_pubmed as 'Publication year', cited_by_count AS citations\
-            FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            ORDER BY year_pubmed DESC".format(country=country_code,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
-    df = pd.read_sql(query, conn)
-    
-    
-    df['Years_duration'] = df['Publication year'].apply(lambda x: 2025-x)
-    df = df.groupby(by='Publication year',as_index=False).sum()
-    df['Average annual citation rate'] = df['citations'] / df['Years_duration']
+    # citations summed over papers divided by the summed years since publication (as of 2025)
+    df = read_per_year(queries.AACR_PER_YEAR, country_code, year_range,
+                       ['Publication year', 'citations', 'Years_duration', 'Average annual citation rate'],
+                       lambda s: (s.year, s.sum_citations, s.n_papers * (2025 - s.year),
+                                  summary_ratio(s.sum_citations, s.n_papers * (2025 - s.year))),
+                       ascending=True)
     return df
 
+@query_cache.memoize
 def references_per_year_per_country(country_code, year_range):
-    query = "SELECT year_pubmed as Year, ROUND(AVG(n_references),2) as 'Average number of references' FROM publications\
-         WHERE majority_country = '{country}'\
-         AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-         GROUP BY year_pubmed\
-         ORDER BY year_pubmed DESC".format(country=country_code,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
-    ref_per_year = pd.read_sql(query, conn)
+    ref_per_year = read_per_year(queries.REFERENCES_PER_YEAR, country_code, year_range,
+                                 ['Year', 'Average number of references'],
+                                 lambda s: (s.year, summary_ratio(s.sum_references, s.n_references_known, 2)))
     return ref_per_year
 
-def countries_str_to_list(x):
-    lst = list(filter(None, x.replace("[", "")\
-                             .replace("]", "")\
-                             .replace("'", "")\
-                             .replace(" ", "")\
-                             .split(',')))
-    
-    return(lst)
-
-
+@query_cache.memoize
 def foreign_collaborators_perc(selected_country, year_range): 
-    query = "SELECT year_pubmed as Year, GROUP_CONCAT(countries) AS all_countries\
-            FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            GROUP BY year_pubmed\
-            ORDER BY year_pubmed DESC".format(country=selected_country,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
+    import pandas as pd
+    query = queries.FOREIGN_AFFILIATIONS_PER_YEAR
+    params = query_params(year_range, country=selected_country)
             
-    df = pd.read_sql(query, conn)
-
-    df['all_countries'] = df['all_countries'].apply(lambda x: countries_str_to_list(x))
-    df['Home affiliations'] =  df['all_countries'].apply(lambda x: round(100*x.count(selected_country)/len(x),2))
+    df = pd.read_sql(query, pool.connection(), params=params)
     df['Foreign affiliations'] = df['Home affiliations'].apply(lambda x: 100 - x)
         
     return df
 
-def count_foreign_only(x,country,other_level=5):
-    '''function required by 'each_foreign_collaborator_perc' function'''
-    lst = list(filter(None, x.replace("[", "")\
-                             .replace("]", "")\
-                             .replace("'", "")\
-                             .replace(" ", "")\
-                             .split(',')))
-
-    #print(country)
-    foreign_countries= [x for x in lst if x != country]
-    counts = Counter(foreign_countries)
-    counts_perc = {x: round(100*counts[x]/sum(counts.values()),2) for x in counts.keys()}
-    sorted_counts= dict(sorted(counts_perc.items(), key=lambda item: item[1], reverse=True))
-    counts_reduced = {x: sorted_counts[x] for x in sorted_counts.keys() if sorted_counts[x] >= other_level}
-    counts_reduced['Other'] = sum([x for x in sorted_counts.values() if x < other_level])
-
-    return(counts_reduced)
-
+def group_foreign_other(df, other_level=5):
+    '''function required by 'each_foreign_collaborator_perc' function:
+    merges countries below other_level percent of a year into 'Other' '''
+    import pandas as pd
+    years = df[['Year']].drop_duplicates()
+    # years without foreign affiliations only come with a NULL country
+    df = df.dropna(subset=['country'])
+    df['value'] = (100*df['n']/df.groupby('Year')['n'].transform('sum')).round(2)
+    is_other = df['value'] < other_level
+    other = df[is_other].groupby('Year', as_index=False, sort=False)['value'].sum()
+    other['country'] = 'Other'
+    # every year gets an 'Other' entry (possibly 0), listed after its countries
+    other = years.merge(other, on='Year', how='left').fillna({'value': 0, 'country': 'Other'})
+    df = pd.concat([df[~is_other], other]).drop(columns=['n'])
+    return df.sort_values('Year', ascending=False, kind='stable').reset_index(drop=True)
+
+@query_cache.memoize
 def each_foreign_collaborator_perc(selected_country, year_range):
     '''Percentage of Foreign countries from all foreign affiliations for each year'''
 
-    query = "SELECT year_pubmed as Year, GROUP_CONCAT(countries) AS all_countries\
-            FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            GROUP BY year_pubmed\
-            ORDER BY year_pubmed DESC".format(country=selected_country,
-                                            year_start=year_range[0],
-                                            year_end=year_range[1])
-
-    df = pd.read_sql(query, conn)
-
-    df['all_countries'] = df['all_countries'].apply(lambda x: count_foreign_only(x, selected_country))
-    df['country'] = df['all_countries'].apply(lambda x: list(x.keys()))
-    df['value'] = df['all_countries'].apply(lambda x: list(x.values()))
-    df_exploded = df.explode(['country', 'value']).drop(columns=['all_countries'])
+    import pandas as pd
+    query = queries.FOREIGN_COUNTRIES_PER_YEAR
+    params = query_params(year_range, country=selected_country)
+
+    df = pd.read_sql(query, pool.connection(), params=params)
     
-    return df_exploded
-
-
-def top_journals_ranking(selected_country, year_range): 
-    query = "SELECT journal_title AS Journal, COUNT(*) as Articles\
-            FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            GROUP BY journal\
-            ORDER BY Articles DESC".format(country=selected_country,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
-            
-    df = pd.read_sql(query, conn)
+    return group_foreign_other(df)
+
+
+@query_cache.memoize_per_db
+def journal_counts():
+    # country x journal x year; journal ids map to titles through journal_titles
+    return GroupedYearSums.from_rows(pool.connection().execute(queries.JOURNAL_COUNTS))
+
+@query_cache.memoize_per_db
+def journal_titles():
+    return dict(pool.connection().execute(queries.JOURNAL_TITLES).fetchall())
+
+# bars of the journals ranking; set NMR_TOP_JOURNALS_OTHER=1 to add the remaining
+# articles of the country as a last 'Other' bar
+TOP_JOURNALS_N = 15
+TOP_JOURNALS_OTHER = os.environ.get('NMR_TOP_JOURNALS_OTHER') == '1'
+
+def top_journals_ranking(selected_country, year_range, n=TOP_JOURNALS_N, other=TOP_JOURNALS_OTHER):
+    '''n journals with most articles, ties in alphabetical order; with other=True the
+    articles of all other journals follow as one 'Other' row'''
+    import pandas as pd
+    titles = journal_titles()
+    top = journal_counts().top(selected_country, year_range, n)
+    df = pd.DataFrame([(titles[journal_id], count) for journal_id, count in top], columns=['Journal', 'Articles'])
+    if other and top:
+        # the rest is the country's total minus the top, the long tail is never summed up
+        rest = country_year_sums().total(selected_country, year_range) - sum(count for _, count in top)
+        if rest > 0:
+            df.loc[len(df)] = ['Other', rest]
     return df
 
 
-def format_dccGraph(fig):
-    return dcc.Graph(id='top-plot', responsive=True, style={'width': '100%', 'height': '100%'},
+def format_dccGraph(fig, graph_id='top-plot'):
+    return dcc.Graph(id=graph_id, responsive=True, style={'width': '100%', 'height': '100%'},
                      figure=fig, config = {'toImageButtonOptions': {'format': 'png',
                                                                         'filename': 'hr_plot',
                                                                         'height': 1080,
@@ -215,18 +335,21 @@ def format_dccGraph(fig):
                                                'displayModeBar': True})
     
 
-def top_cited_papers(selected_country, year_range): 
-    query = "SELECT title_pubmed AS Title, cit_per_year AS 'Annual citation rate', pmid as PMID, year_pubmed as 'Year'\
-            FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            ORDER BY cit_per_year DESC\
-            LIMIT 10\
-            ".format(country=selected_country,
-                     year_start=year_range[0],
-                     year_end=year_range[1])
-            
-    df = pd.read_sql(query, conn)
+@query_cache.memoize_per_db
+def top_cited_lists():
+    return YearTopLists.from_rows(pool.connection().execute(queries.TOP_CITED_LISTS), TOP_CITED_DEPTH)
+
+def top_cited_papers(selected_country, year_range, k=10):
+    import pandas as pd
+    lists = top_cited_lists()
+    if k <= lists.depth:
+        # merged from the per-year top lists instead of sorting all papers of the country
+        rows = lists.top(selected_country, year_range, k)
+        df = pd.DataFrame.from_records(rows, columns=['Title', 'Annual citation rate', 'PMID', 'Year'], coerce_float=True)
+    else:
+        query = queries.TOP_CITED_PAPERS
+        params = query_params(year_range, country=selected_country, k=k)
+        df = pd.read_sql(query, pool.connection(), params=params)
     df['Annual citation rate'] = df['Annual citation rate'].apply(lambda x: round(x,2))
     return df
 
@@ -234,187 +357,304 @@ def top_cited_papers(selected_country, year_range):
 ########################## FUNCTIONS FOR GEOJSON MAP ##########################
 
 
-def get_color(value, min_val=0, max_val=200, cmap_name='Blues'):
-    norm = mcolors.Normalize(vmin=min_val, vmax=max_val)
-    cmap = cm.get_cmap(cmap_name)  # Use cm.get_cmap() to retrieve the colormap
-    rgba = cmap(norm(value))
-    return mcolors.to_hex(rgba)
-
-# def get_color_avg_authors(value, min_val=0, max_val=200, cmap_name='RdBu'):
-#     norm = mcolors.Normalize(vmin=min_val, vmax=max_val)
-#     cmap = cm.get_cmap(cmap_name)  # Use cm.get_cmap() to retrieve the colormap
-#     rgba = cmap(norm(value))
-#     return mcolors.to_hex(rgba)
-
-def sum_collabs_in_years(x):
-    if not x.empty:
-        result = sum((Counter(d) for d in x), Counter())
-        result_dict = dict(result)
-        return result_dict
-    
-        # SLOWER METHOD
-        # result = defaultdict(int)
-        # for d in x:
-        #     for key, value in d.items():
-        #         result[key] += value
+# ColorBrewer anchor colors of matplotlib's 'Blues' and 'RdBu' colormaps
+COLORMAP_ANCHORS = {
+    'Blues': ['#f7fbff', '#deebf7', '#c6dbef', '#9ecae1', '#6baed6', '#4292c6', '#2171b5', '#08519c', '#08306b'],
+    'RdBu': ['#67001f', '#b2182b', '#d6604d', '#f4a582', '#fddbc7', '#f7f7f7', '#d1e5f0', '#92c5de', '#4393c3',
+             '#2166ac', '#053061'],
+}
 
-        # sorted_result = dict(sorted(result.items(), key=lambda item: item[1], reverse=True))
-        
-        # return dict(sorted_result)
-    else: 
-        return {}
-
-def collabs_dict(x, country):
-    lst = list(filter(None, x['all_countries'].replace("[", "")\
-                                              .replace("]", "")\
-                                              .replace("'", "")\
-                                              .replace(" ", "")\
-                                              .split(',')))
-    
-    foreign_countries= [x for x in lst if x != country]
-    collabs = dict(Counter(foreign_countries))
-    #collabs = {x: lst.count(x) for x in lst if x != country}
-    #print(collabs)
-    sorted_collabs = dict(sorted(collabs.items(), key=lambda item: item[1], reverse=True))
-    
-    return(sorted_collabs)
-    
+def build_color_lut(anchors, n=256):
+    '''n hex colors linearly interpolated between evenly spaced anchors, the same table
+    matplotlib builds for these colormaps'''
+    rgb = np.array([[int(c[i:i+2], 16) / 255 for i in (1, 3, 5)] for c in anchors])
+    x = np.linspace(0, 1, n)
+    lut = np.column_stack([np.interp(x, np.linspace(0, 1, len(anchors)), rgb[:, i]) for i in range(3)])
+    return np.array(['#%02x%02x%02x' % tuple(c) for c in np.round(lut * 255).astype(int)])
+
+COLOR_LUTS = {cmap_name: build_color_lut(anchors) for cmap_name, anchors in COLORMAP_ANCHORS.items()}
+
+def get_colors(values, min_val=0, max_val=200, cmap_name='Blues'):
+    '''hex colors of an array of values normalized to [min_val, max_val], out of range
+    values get the end colors'''
+    lut = COLOR_LUTS[cmap_name]
+    values = np.asarray(values, dtype=float)
+    if max_val == min_val:
+        scaled = np.zeros_like(values)
+    else:
+        scaled = (values - min_val) / (max_val - min_val)
+    return lut[np.clip(np.floor(scaled * len(lut)), 0, len(lut) - 1).astype(int)]
+
+def map_styles(values, min_val, max_val, cmap_name='Blues'):
+    '''map styles of {country_code: value}, colored in one vectorized lookup'''
+    colors = get_colors(list(values.values()), min_val, max_val, cmap_name)
+    return {country_code: {'fillColor': str(color), 'fillOpacity': 0.8, 'color': 'black', 'weight': 1}
+            for country_code, color in zip(values, colors)}
+
+# Send raw values, their domain and the colormap anchors to the browser and let
+# style_handle interpolate the colors, instead of a full style dict per country
+CLIENT_SIDE_COLORS = True
+
+SELECTED_STYLE = {'fillColor': 'red', 'fillOpacity': 0.5, 'color': 'black', 'weight': 2.5}
+
+def map_hideout(values, min_val=0, max_val=1, cmap_name='Blues', selected=None):
+    '''hideout of the GeoJSON layer coloring {country_code: value}, with the clicked
+    country highlighted unless it has a value itself'''
+    if CLIENT_SIDE_COLORS:
+        if not values:
+            return {'selected': selected}
+        return {'values': values, 'domain': [min_val, max_val],
+                'colorscale': COLORMAP_ANCHORS[cmap_name], 'selected': selected}
+    styles = {selected: SELECTED_STYLE} if selected else {}
+    styles.update(map_styles(values, min_val, max_val, cmap_name))
+    return {'styles': styles}
+
+@query_cache.memoize_per_db
+def co_affiliations():
+    # home country x partner country x year, sliced by collaborators without querying SQLite
+    return GroupedYearSums.from_rows(pool.connection().execute(queries.CO_AFFILIATIONS))
 
 def collaborators(selected_country, year_range):
-    styles = {}
- 
-    query = "SELECT year_pubmed, GROUP_CONCAT(countries) AS all_countries\
-            FROM publications\
-            WHERE majority_country = '{country}'\
-            AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-            GROUP BY year_pubmed\
-            ORDER BY year_pubmed DESC".format(country=selected_country,
-                                           year_start=year_range[0],
-                                           year_end=year_range[1])
-            
-    df = pd.read_sql(query, conn)
-    #df['collabs'] = df.apply(lambda x: collabs_dict(x, selected_country), axis=1)
-    collab_dict = df.apply(lambda x: collabs_dict(x, selected_country), axis=1)
-    summed_collab_dict = sum_collabs_in_years(collab_dict)
+    # ranked by number of affiliations, then partner country
+    summed_collab_dict = co_affiliations().ranking(selected_country, year_range)
     max_collab = max(summed_collab_dict.values()) if summed_collab_dict else 1  # Avoid division by zero
         
-    # Assign colors based on collaboration frequency
-    for country_code, freq in summed_collab_dict.items():
-        styles[country_code] = {
-            'fillColor': get_color(freq, min_val=0, max_val=max_collab, cmap_name='Blues'),
-            'fillOpacity': 0.8, 
-            'color': 'black',
-            'weight': 1
-        }
-    #print(styles)
-    return styles, max_collab, summed_collab_dict
+    return max_collab, summed_collab_dict
+
+@query_cache.memoize_per_db
+def country_year_sums():
+    # loaded once per database file, the map metrics below never query SQLite
+    return CountryYearSums.from_db(pool.connection())
 
 def avg_number_authors(year_range, min_records):
-    styles = {}
-    
-    query = "SELECT majority_country,ROUND(AVG(authors_number),2) FROM publications\
-                WHERE majority_country != 'Multinational'\
-                AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-                GROUP BY majority_country\
-                HAVING COUNT(*) >= {min_papers}".format(year_start=year_range[0],
-                                                          year_end=year_range[1],
-                                                          min_papers = min_records)
-                
-    cursor.execute(query)
-    result_dict = dict(cursor.fetchall())
+    result_dict = country_year_sums().map_ratio(year_range, min_records, 'sum_authors', 'n_authors_known')
     max_av_authors = max(result_dict.values(), default=100)
     min_av_authors = min(result_dict.values(), default=1)
     
-    # Assign colors based on number of average number of authors
-    for country_code, av_authors in result_dict.items():
-        styles[country_code] = {
-            'fillColor': get_color(av_authors, min_val=min_av_authors,
-                                   max_val=max_av_authors, cmap_name='Blues'),
-            'fillOpacity': 0.8, 
-            'color': 'black',
-            'weight': 1
-        }
-    #print(min_records)
-    return styles, min_av_authors, max_av_authors, result_dict
+    return min_av_authors, max_av_authors, result_dict
 
 def avg_number_references(year_range, min_records):
-    styles = {}
-    
-    query = "SELECT majority_country,ROUND(AVG(n_references),2) FROM publications\
-                WHERE majority_country != 'Multinational'\
-                AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-                GROUP BY majority_country\
-                HAVING COUNT(*) >= {min_papers}".format(year_start=year_range[0],
-                                                          year_end=year_range[1],
-                                                          min_papers = min_records)
-                
-    cursor.execute(query)
-    result_dict = dict(cursor.fetchall())
+    result_dict = country_year_sums().map_ratio(year_range, min_records, 'sum_references', 'n_references_known')
     max_av_references = max(result_dict.values(), default=100)
     min_av_references = min(result_dict.values(), default=1)
     
-    # Assign colors based on number of average number of authors
-    for country_code, av_references in result_dict.items():
-        styles[country_code] = {
-            'fillColor': get_color(av_references, min_val=min_av_references,
-                                   max_val=max_av_references, cmap_name='Blues'),
-            'fillOpacity': 0.8, 
-            'color': 'black',
-            'weight': 1
-        }
-    #print(min_records)
-    return styles, min_av_references, max_av_references, result_dict
+    return min_av_references, max_av_references, result_dict
 
 
 def open_access_perc(year_range, min_records):
-    styles = {}
-    
-    query = "SELECT majority_country, ROUND(CAST(SUM(is_open_access) AS FLOAT)*100 / COUNT(is_open_access),1) FROM publications\
-                WHERE majority_country != 'Multinational'\
-                AND year_pubmed BETWEEN '{year_start}' AND '{year_end}'\
-                GROUP BY majority_country\
-                HAVING COUNT(*) >= {min_papers}".format(year_start=year_range[0],
-                                                          year_end=year_range[1],
-                                                          min_papers = min_records)
-                
-    cursor.execute(query)
-    result_dict = dict(cursor.fetchall())
+    result_dict = country_year_sums().map_ratio(year_range, min_records, 'n_open_access', 'n_open_access_known',
+                                                scale=100, decimals=1)
     #max_perc_oa = max(result_dict.values(), default=100)
     #min_perc_oa = min(result_dict.values(), default=0)
     
-    # Assign colors based on number of average number of authors
-    for country_code, oa_perc in result_dict.items():
-        styles[country_code] = {
-            'fillColor': get_color(oa_perc, min_val=0,
-                                   max_val=100, cmap_name='RdBu'),
-            'fillOpacity': 0.8, 
-            'color': 'black',
-            'weight': 1
-        }
-    return styles, result_dict
+    return result_dict
 
 
     
     
 #########################################
-### CONNECT DB ###
-#########################################    
+### PLOT TYPES ###
+#########################################
 
+_plotly_express = None
+_plotly_express_lock = threading.Lock()
+
+def plotly_express():
+    '''plotly.express, imported on first use. plotly also builds the parts of a template on
+    first use, which is not thread-safe: the first figures of concurrent callbacks failed
+    with ValueError('Invalid value'). So the first caller builds one figure while the
+    others wait.'''
+    global _plotly_express
+    with _plotly_express_lock:
+        if _plotly_express is None:
+            import pandas as pd
+            import plotly.express as px
+            px.bar(pd.DataFrame({'x': [0], 'y': [0]}), x='x', y='y', template='plotly_white')
+            _plotly_express = px
+    return _plotly_express
+
+def year_axis_range(year_range):
+    return [year_range[0]-1, year_range[1]+0.5]
+
+def format_year_axes(fig, year_range):
+    fig.update_xaxes(range=year_axis_range(year_range), title_font=dict(size=14),
+                     tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
+    fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
+
+def single_bar(x, y):
+    '''grey bars of one column per year'''
+    def figure(df, year_range):
+        fig = plotly_express().bar(df, x=x, y=y, orientation='v', template='plotly_white')
+        fig.update_traces(marker_color='grey', width=0.5)
+        fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
+        format_year_axes(fig, year_range)
+        return fig
+    # (x, y) columns of each trace, see patch_plot
+    figure.traces = [(x, y)]
+    return figure
+
+def share_bar(y, yaxis_title):
+    '''stacked percentages of two columns per year, the first one highlighted'''
+    def figure(df, year_range):
+        fig = plotly_express().bar(df, x='Year', y=y, orientation='v', template='plotly_white',
+                     color_discrete_map={y[0]: 'black', y[1]: 'rgba(0, 0, 0, 0.1)'})
+        fig.update_traces(width=0.5)
+        fig.update_layout(yaxis_title=yaxis_title, bargap=0.2, hoverlabel=dict(font=dict(color='white')),
+                          legend=dict(title='', orientation='h', yanchor='top', y=1.1, xanchor='center', x=0.5))
+        format_year_axes(fig, year_range)
+        fig.for_each_trace(lambda trace: trace.update(hovertemplate=f"<span style='color:{'white' if trace.name == y[0] else 'black'}'>"
+                                                                    f"{trace.name}: %{{y}}%</span><extra></extra>"))
+        return fig
+    figure.traces = [('Year', column) for column in y]
+    return figure
+
+def foreign_countries_bar(df, year_range):
+    import pandas as pd
+    px = plotly_express()
+    country_order=df.groupby('country')['value'].aggregate('sum').sort_values(ascending=False)
+    other_idx = [i for i, x in enumerate(country_order.index == 'Other') if x == True][0]
+    country_order2 = country_order.drop('Other')
+    country_order2 = pd.concat((country_order2,country_order.iloc[other_idx:other_idx+1])) # move 'Other' to the end
+    
+    default_colors = px.colors.qualitative.Alphabet  # color scheme
+    color_mapping = {}
+    # Assign colors to other countries dynamically
+    for i, country in enumerate(country_order2.index):
+        if country not in color_mapping:
+            color_mapping[country] = default_colors[i % len(default_colors)]
+    
+    color_mapping['Other'] = 'black' # Assign black to 'Other'
 
-# Path to the preloaded database
-DB_FILE = '/var/data/data.db'
+    fig = px.bar(df, x='Year', y='value', color='country', orientation='v',
+                 template='plotly_white', category_orders={'country': list(color_mapping.keys())},
+                 color_discrete_map=color_mapping, text='country')
+    
+    fig.update_traces(width=0.5)
+    fig.update_layout(yaxis_title='Foreign affiliations (%)', bargap=0.2)
+    format_year_axes(fig, year_range)
+    
+    #add annotation for downloading high-resolution plot
+    fig.update_layout(annotations=[dict(text='Download in high-resolution', 
+                xref='paper', yref='paper',
+                x=1.0, y=1.02, xanchor='right', yanchor='bottom',
+                showarrow=False,
+                font=dict(size=12, color='grey'))])
+    return fig
+
+def top_journals_bar(df, year_range):
+    fig = plotly_express().bar(df, y='Journal', x='Articles', orientation='h', template='plotly_white')
+    fig.update_traces(marker_color=['black' if journal == 'Other' else 'grey' for journal in df['Journal']], width=0.5)
+    # ranked top down as returned by top_journals_ranking, 'Other' at the bottom
+    fig.update_layout(yaxis_title='', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
+                      yaxis=dict(categoryorder='array', categoryarray=df['Journal'].tolist()[::-1]),
+                      margin=dict(l=0, r=20, t=50, b=50))
+    fig.update_xaxes(title_font=dict(size=14),tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
+    fig.update_yaxes(title_font=dict(size=10), tickfont=dict(size=10), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
+    return fig
+
+def top_articles_table(df, year_range):
+    # the same frame may be rendered in both panels, so it is not modified in place
+    df = df.assign(PMID=df['PMID'].apply(lambda x: f'[{x}](https://pubmed.ncbi.nlm.nih.gov/{x}/)'))
+    return dash_table.DataTable(
+        columns=[{'name': col, 'id': col, 'presentation': 'markdown'} for col in df.columns],
+        data=df.to_dict('records'),
+        style_table={'width': '100%', 'height': '400px', 'overflowX': 'auto'},
+        style_header={'backgroundColor': 'grey', 'color': 'white', 'fontSize': 10, 'textAlign': 'center'},
+        style_cell={'textAlign': 'left', 'whiteSpace': 'normal', 'overflow': 'hidden',
+                    'textOverflow': 'ellipsis','maxWidth': '200px', 'maxHeight': '100px'},
+        style_data_conditional=[
+                {'if': {'column_id': 'Title'}, 'width': '70%'},
+                {'if': {'column_id': 'Annual citation rate'}, 'width': '10%', 'fontWeight': 'bold'},
+                {'if': {'column_id': 'PMID'}, 'width': '10%'},
+                {'if': {'column_id': 'Year'}, 'width': '10%',}],
+        style_data={'fontSize': 10}
+        )
 
-# Load GeoJSON data (still needed)
-with open('./maps/world.geojson') as f:
-    countries = json.load(f)
 
-# Create Persistent SQLite Connection (Better Performance)
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cursor = conn.cursor()
+# Plot types of the top and bottom panels: dropdown value -> label, data function
+# (country_code, year_range) -> DataFrame, and builder (df, year_range) -> figure or component.
+# Builders with a `traces` attribute draw one trace per (x, y) column pair and are patched
+# instead of rebuilt when only the year range changes.
+PLOT_TYPES = {
+    'plot_pub_num': dict(label='Number of articles',
+                         data=get_pubs_per_year_per_country,
+                         figure=single_bar('Year', 'Articles')),
+    'plot_open_acc': dict(label='Open access articles (%)',
+                          data=openacces_per_year_per_country,
+                          figure=share_bar(['Open access', 'Paid access'], 'Articles (%)')),
+    'plot_av_auth_num': dict(label='Number of authors',
+                             data=av_authors_per_year_per_country,
+                             figure=single_bar('Year', 'Average number of authors')),
+    'plot_av_ref_num': dict(label='Number of references',
+                            data=references_per_year_per_country,
+                            figure=single_bar('Year', 'Average number of references')),
+    'plot_foreign_collabs_perc': dict(label='Total foreign affiliations (%)',
+                                      data=foreign_collaborators_perc,
+                                      figure=share_bar(['Foreign affiliations', 'Home affiliations'], 'Affiliations (%)')),
+    'plot_foreign_collabs_countries_perc': dict(label='Foreign affiliation countries (%)',
+                                                data=each_foreign_collaborator_perc,
+                                                figure=foreign_countries_bar),
+    'plot_top_journals': dict(label='Most popular journals',
+                              data=top_journals_ranking,
+                              figure=top_journals_bar),
+    'table_top_articles': dict(label=dcc.Markdown('Most frequently cited articles<sup>*as of Mar 2025</sup>',dangerously_allow_html=True),
+                               data=top_cited_papers,
+                               figure=top_articles_table),
+    'plot_aacr': dict(label='Average annual citation rate',
+                      data=aacr_per_year_per_country,
+                      figure=single_bar('Publication year', 'Average annual citation rate')),
+}
 
-# Create Index for Faster Queries (Only Run Once)
-cursor.execute('CREATE INDEX IF NOT EXISTS idx_year_pubmed ON publications(year_pubmed);')
-conn.commit()  # Save changes
+def plot_dropdown_options():
+    return [{'label': 'No plot', 'value': 'no_plot'}] + \
+           [{'label': plot['label'], 'value': plot_type} for plot_type, plot in PLOT_TYPES.items()]
+
+def plot_data_bundle(country_code, year_range, plot_types):
+    '''data of every requested plot type, each fetched once even if shown in both panels'''
+    def fetch(plot_type):
+        with timed(PLOT_SECONDS, f'data.{plot_type}', plot_type=plot_type, stage='data'):
+            return PLOT_TYPES[plot_type]['data'](country_code, year_range)
+
+    plot_types = sorted({plot_type for plot_type in plot_types if plot_type in PLOT_TYPES})
+    # the panels' queries are independent, so the ones not cached yet run side by side;
+    # helpers answered from the in-memory tables (not memoized) are quicker inline
+    missing = [plot_type for plot_type in plot_types
+               if hasattr(PLOT_TYPES[plot_type]['data'], 'uncached')
+               and not query_cache.contains(PLOT_TYPES[plot_type]['data'], country_code, year_range)]
+    bundle = dict(zip(missing, fetch_pool.map(fetch, missing)))
+    bundle.update((plot_type, fetch(plot_type)) for plot_type in plot_types if plot_type not in bundle)
+    return bundle
+
+def render_plot(plot_type, df, year_range, graph_id):
+    if df.empty:
+        return format_dccGraph(empty_df_info(), graph_id)
+    output = PLOT_TYPES[plot_type]['figure'](df, year_range)
+    if isinstance(output, go.Figure):
+        return format_dccGraph(output, graph_id)
+    return output
+
+def is_patchable(plot_type, df):
+    return hasattr(PLOT_TYPES[plot_type]['figure'], 'traces') and not df.empty
+
+def patch_plot(plot_type, df, year_range):
+    '''update of a rendered figure to another year range that only sends the trace arrays
+    and the x axis range, leaving template, styling and hover texts as they are'''
+    patch = Patch()
+    figure = patch['props']['figure']
+    for i, (x, y) in enumerate(PLOT_TYPES[plot_type]['figure'].traces):
+        figure['data'][i]['x'] = df[x].tolist()
+        figure['data'][i]['y'] = df[y].tolist()
+    figure['layout']['xaxis']['range'] = year_axis_range(year_range)
+    return patch
+
+def select_prompt(graph_id):
+    return format_dccGraph(go.Figure(layout=go.Layout(
+        title=dict(text='Click on a country and select plot type', x=0.5, y=0.5, 
+                    xanchor='center', yanchor='top'),
+        template='plotly_white',
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False)
+    )), graph_id)
 
 
 #########################################
@@ -427,11 +667,41 @@ app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP],suppress_c
 
 server = app.server  
 
-app.layout = dbc.Container([
+
+# Map geometry is fetched by dl.GeoJSON from a URL that contains the hash of the file,
+# so browsers and proxies may keep it forever and the layout stays small.
+def map_url(level):
+    return app.get_relative_path(f'/maps/world_lod{level}.{map_levels[level]["digest"]}.geojson')
+
+def map_level_urls():
+    # read by the mapDetail callback in assets/clientside.js
+    return [dict(url=map_url(level), min_zoom=min_zoom) for level, (min_zoom, _, _) in enumerate(LEVELS)]
+
+@server.route('/maps/world_lod<int:level>.<digest>.geojson')
+def map_geometry(level, digest):
+    if level >= len(map_levels) or map_levels[level]['digest'] != digest:
+        abort(404)
+    variants = map_levels[level]['variants']
+    encoding = request.accept_encodings.best_match([e for e in ENCODINGS if e in variants], default='identity')
+    response = Response(variants[encoding], mimetype='application/geo+json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(f'{digest}-{encoding}')
+    # 304 Not Modified when the browser revalidates with If-None-Match
+    return response.make_conditional(request)
+
+layout = dbc.Container([
     dbc.Row([
         
         dbc.Col([
             dcc.Store(id='stored-min-papers', data=100),
+            dcc.Store(id='map-level', data=0),
+            dcc.Store(id='map-levels', data=map_level_urls()),
+            # country and plot type rendered in each panel, None for the prompt
+            dcc.Store(id='top-plot-state'),
+            dcc.Store(id='bottom-plot-state'),
             dcc.Dropdown(
                 id='metric-dropdown',
                 options=[
@@ -455,8 +725,8 @@ app.layout = dbc.Container([
             html.Div(id='extra-info-top',
                      style={'textAlign': 'center', 'fontSize': '12px', 'padding': '1px', 'backgroundColor': 'rgba(0, 0, 0, 0.135)'},
                      children='\u00A0'),
-            dl.Map(center=[20, 0], zoom=2, attributionControl=False, children=[
-                dl.GeoJSON(data=countries,
+            dl.Map(id='map', center=[20, 0], zoom=2, attributionControl=False, children=[
+                dl.GeoJSON(url=map_url(0),
                            id='geojson',
                            style=style_handle,  # use the dynamic style function
                            hoverStyle=dict(weight=3, color='red'),
@@ -465,13 +735,20 @@ app.layout = dbc.Container([
                 ], style={'height': '700px', 'width': '100%'}),
                 html.Div(id='extra-info',style={'textAlign': 'center', 'fontSize': '14px', 'padding': '10px','backgroundColor': '#f0f0f0'},
                         children=[html.Span(id='info-text', children='\u00A0'),  # Placeholder text
-                                dcc.Input(
-                                    id='min-papers-input',
-                                    type='number',
-                                    placeholder='100',
-                                    value=100,
-                                    style={'display': 'none'}  # Initially hidden
-                                    )
+                                # lower limit of publications of the per-country map metrics,
+                                # shown by the minPapersStyle callback in assets/clientside.js
+                                html.Span(id='min-papers-info', style={'display': 'none'}, children=[
+                                    'Include countries with at least ',
+                                    dcc.Input(
+                                        id={'type': 'dynamic-input', 'id': 'min-papers-input'},
+                                        type='number',
+                                        debounce=True,
+                                        placeholder='100',
+                                        value=100,
+                                        style={'display': 'inline-block', 'width': '60px', 'margin': '0 5px'}
+                                        ),
+                                    ' publications in a selected years range (confirm by pressing enter)'
+                                    ])
                                 ]
                          )
             ],width=8),
@@ -480,18 +757,7 @@ app.layout = dbc.Container([
         dbc.Col(
             [dcc.Dropdown(
                 id='top-plot-dropdown',
-                options=[
-                    {'label': 'No plot', 'value': 'no_plot'},
-                    {'label': 'Number of articles', 'value': 'plot_pub_num'},
-                    {'label': 'Open access articles (%)', 'value': 'plot_open_acc'},
-                    {'label': 'Number of authors', 'value': 'plot_av_auth_num'},
-                    {'label': 'Number of references', 'value': 'plot_av_ref_num'},
-                    {'label': 'Total foreign affiliations (%)', 'value': 'plot_foreign_collabs_perc'},
-                    {'label': 'Foreign affiliation countries (%)', 'value': 'plot_foreign_collabs_countries_perc'},
-                    {'label': 'Most popular journals', 'value': 'plot_top_journals'},
-                    {'label': dcc.Markdown('Most frequently cited articles<sup>*as of Mar 2025</sup>',dangerously_allow_html=True), 'value': 'table_top_articles'},
-                    {'label': 'Average annual citation rate', 'value': 'plot_aacr'},
-                ],
+                options=plot_dropdown_options(),
                 clearable=False,
                 style={
                     'textAlign': 'center',
@@ -508,18 +774,7 @@ app.layout = dbc.Container([
             
             dcc.Dropdown(
                 id='bottom-plot-dropdown',
-                options=[
-                    {'label': 'No plot', 'value': 'no_plot'},
-                    {'label': 'Number of articles', 'value': 'plot_pub_num'},
-                    {'label': 'Open access articles (%)', 'value': 'plot_open_acc'},
-                    {'label': 'Number of authors', 'value': 'plot_av_auth_num'},
-                    {'label': 'Number of references', 'value': 'plot_av_ref_num'},
-                    {'label': 'Total foreign affiliations (%)', 'value': 'plot_foreign_collabs_perc'},
-                    {'label': 'Foreign affiliation countries (%)', 'value': 'plot_foreign_collabs_countries_perc'},
-                    {'label': 'Most popular journals', 'value': 'plot_top_journals'},
-                    {'label': dcc.Markdown('Most frequently cited articles<sup>*as of Mar 2025</sup>',dangerously_allow_html=True), 'value': 'table_top_articles'},
-                    {'label': 'Average annual citation rate', 'value': 'plot_aacr'},
-                ],
+                options=plot_dropdown_options(),
                 clearable=False,
                 style={
                     'textAlign': 'center',
@@ -549,441 +804,257 @@ app.layout = dbc.Container([
             )
         ], width=28)
     ], style={'padding': '20px'})
-], fluid=True)    
+], fluid=True)
+
+def serve_layout():
+    # every page load is a new session, see latest_requests
+    return html.Div([dcc.Store(id='session-id', data=uuid.uuid4().hex), layout])
+
+app.layout = serve_layout
 
 
 #########################################
-### TOP PLOT CALLBACKS ###
-#########################################  
+### CACHE WARM-UP ###
+#########################################
 
-@app.callback(Output('top-plot-container', 'children'),
-              [Input('geojson', 'clickData'),
-               Input('year-slider', 'value'),
-               Input('top-plot-dropdown', 'value')])
-def update_chart_top(click_data, year_range, dropdown):
-    if click_data and 'properties' in click_data and 'ISO_A2' in click_data['properties']:
-        country_code = click_data['properties']['ISO_A2']
-        
-        # Plot number of articles per year
-        if dropdown == 'plot_pub_num':
-            pubs_per_year = get_pubs_per_year_per_country(country_code, year_range)
-            fig = px.bar(pubs_per_year, x='Year', y='Articles', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if pubs_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot open access percentage per year
-        if dropdown == 'plot_open_acc':
-            oa_per_year = openacces_per_year_per_country(country_code, year_range)
-            fig = px.bar(oa_per_year, x='Year', y=['Open access', 'Paid access'], orientation='v', template='plotly_white',
-                         color_discrete_map={'Open access': 'black', 'Paid access': 'rgba(0, 0, 0, 0.1)'})
-            fig.update_traces(width=0.5)
-            fig.update_layout(yaxis_title='Articles (%)', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
-                              legend=dict(title='', orientation='h', yanchor='top', y=1.1, xanchor='center', x=0.5))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            fig.for_each_trace(lambda trace: trace.update(hovertemplate=f"<span style='color:{'white' if trace.name == 'Open access' else 'black'}'>"
-                                                                        f"{trace.name}: %{{y}}%</span><extra></extra>"))  
-            if oa_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot Average number of authors per year
-        if dropdown == 'plot_av_auth_num':
-            av_auth_per_year = av_authors_per_year_per_country(country_code, year_range)
-            fig = px.bar(av_auth_per_year, x='Year', y='Average number of authors', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if av_auth_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot Average number of references per year
-        if dropdown == 'plot_av_ref_num':
-            av_ref_per_year = references_per_year_per_country(country_code, year_range)
-            fig = px.bar(av_ref_per_year, x='Year', y='Average number of references', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if av_ref_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot foreign affiliations percentage per year
-        if dropdown == 'plot_foreign_collabs_perc':
-            df = foreign_collaborators_perc(country_code, year_range)
-            fig = px.bar(df, x='Year', y=['Foreign affiliations', 'Home affiliations'], orientation='v', template='plotly_white',
-                         color_discrete_map={'Foreign affiliations': 'black', 'Home affiliations': 'rgba(0, 0, 0, 0.1)'})
-            fig.update_traces(width=0.5)
-            fig.update_layout(yaxis_title='Affiliations (%)', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
-                              legend=dict(title='', orientation='h', yanchor='top', y=1.1, xanchor='center', x=0.5))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            fig.for_each_trace(lambda trace: trace.update(hovertemplate=f"<span style='color:{'white' if trace.name == 'Foreign affiliations' else 'black'}'>"
-                                                                        f"{trace.name}: %{{y}}%</span><extra></extra>"))  
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        
-        # Plot foreign affiliations countries percentage per year
-        if dropdown == 'plot_foreign_collabs_countries_perc':
-            df = each_foreign_collaborator_perc(country_code, year_range)
-            
-            country_order=df.groupby('country')['value'].aggregate('sum').sort_values(ascending=False)
-            other_idx = [i for i, x in enumerate(country_order.index == 'Other') if x == True][0]
-            country_order2 = country_order.drop('Other')
-            country_order2 = pd.concat((country_order2,country_order.iloc[other_idx:other_idx+1])) # move 'Other' to the end
-            
-            default_colors = px.colors.qualitative.Alphabet  # color scheme
-            color_mapping = {}
-            # Assign colors to other countries dynamically
-            for i, country in enumerate(country_order2.index):
-                if country not in color_mapping:
-                    color_mapping[country] = default_colors[i % len(default_colors)]
-            
-            color_mapping['Other'] = 'black' # Assign black to 'Other'
+DEFAULT_YEAR_RANGE = (2000, 2024)  # initial value of the year slider
+
+def warm_up_jobs(n_countries=10):
+    '''what the first visitors see: the in-memory tables behind the map and the
+    rankings, then every panel of the largest producers for the default years'''
+    # the plotting modules first, off the path of the first plot callback
+    plotly_express()
+    jobs = [(country_year_sums, ()), (co_affiliations, ()), (top_cited_lists, ()),
+            (journal_counts, ()), (journal_titles, ())]
+    top_countries = [country for (country,) in pool.connection().execute(queries.TOP_COUNTRIES, dict(n=n_countries))]
+    for country in top_countries:
+        # helpers answered from memory are not cached
+        jobs += [(plot['data'], (country, DEFAULT_YEAR_RANGE)) for plot in PLOT_TYPES.values()
+                 if hasattr(plot['data'], 'uncached')]
+    return jobs
+
+# fills query_cache in the background, started by the first request so that it runs in
+# the serving process (not in a gunicorn master that forks workers)
+cache_warmer = CacheWarmer(query_cache, warm_up_jobs)
+
+@server.before_request
+def start_request():
+    cache_warmer.start()
+    cache_warmer.request_started()
+
+@server.teardown_request
+def finish_request(exc):
+    # the warmer waits until no request has been served for a moment
+    cache_warmer.request_finished()
 
-            fig = px.bar(df, x='Year', y='value', color='country', orientation='v',
-                         template='plotly_white', category_orders={'country': list(color_mapping.keys())},
-                         color_discrete_map=color_mapping, text='country')
-            
-            
-            fig.update_traces(width=0.5)
-            fig.update_layout(yaxis_title='Foreign affiliations (%)', bargap=0.2)
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            
-            #add annotation for downloading high-resolution plot
-            fig.update_layout(annotations=[dict(text='Download in high-resolution', 
-                        xref='paper', yref='paper',
-                        x=1.0, y=1.02, xanchor='right', yanchor='bottom',
-                        showarrow=False,
-                        font=dict(size=12, color='grey'))])
-            
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot top 15 journals
-        if dropdown == 'plot_top_journals':
-            df = top_journals_ranking(country_code, year_range)
-            fig = px.bar(df.head(15), y='Journal', x='Articles', orientation='h', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(yaxis_title='', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
-                              yaxis=dict(categoryorder='total ascending'),margin=dict(l=0, r=20, t=50, b=50))
-            fig.update_xaxes(title_font=dict(size=14),tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=10), tickfont=dict(size=10), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        
-        # Table with top articles
-        if dropdown == 'table_top_articles':
-            df = top_cited_papers(country_code, year_range)
-            df['PMID'] = df['PMID'].apply(lambda x: f'[{x}](https://pubmed.ncbi.nlm.nih.gov/{x}/)')
-            table = dash_table.DataTable(
-            columns=[{'name': col, 'id': col, 'presentation': 'markdown'} for col in df.columns],
-            data=df.to_dict('records'),
-            style_table={'width': '100%', 'height': '400px', 'overflowX': 'auto'},
-            style_header={'backgroundColor': 'grey', 'color': 'white', 'fontSize': 10, 'textAlign': 'center'},
-            style_cell={'textAlign': 'left', 'whiteSpace': 'normal', 'overflow': 'hidden',
-                        'textOverflow': 'ellipsis','maxWidth': '200px', 'maxHeight': '100px'},
-            style_data_conditional=[
-                    {'if': {'column_id': 'Title'}, 'width': '70%'},
-                    {'if': {'column_id': 'Annual citation rate'}, 'width': '10%', 'fontWeight': 'bold'},
-                    {'if': {'column_id': 'PMID'}, 'width': '10%'},
-                    {'if': {'column_id': 'Year'}, 'width': '10%',}],
-            style_data={'fontSize': 10}
-            )
 
-            if df.empty:
-                fig = empty_df_info()
-                return format_dccGraph(fig)
-            else:
-                return table
-
-        # Plot AACR
-        if dropdown == 'plot_aacr':
-            df = aacr_per_year_per_country(country_code, year_range)
-            fig = px.bar(df, x='Publication year', y='Average annual citation rate', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
+#########################################
+### METRICS ###
+#########################################
 
-        
-    return format_dccGraph(go.Figure(layout=go.Layout(
-        title=dict(text='Click on a country and select plot type', x=0.5, y=0.5, 
-                    xanchor='center', yanchor='top'),
-        template='plotly_white',
-        xaxis=dict(visible=False),
-        yaxis=dict(visible=False)
-    )))
+CALLBACK_SECONDS = registry.histogram('dashboard_callback_seconds', 'Time to answer a Dash callback request',
+                                      ['callback'])
+CALLBACK_BYTES = registry.histogram('dashboard_callback_response_bytes', 'Size of Dash callback responses',
+                                    ['callback'], buckets=metrics.SIZE_BUCKETS)
+PLOT_SECONDS = registry.histogram('dashboard_plot_seconds',
+                                  'Time to fetch the data (stage="data") or draw the figure (stage="figure") of a plot',
+                                  ['plot_type', 'stage'])
+MAP_METRIC_SECONDS = registry.histogram('dashboard_map_metric_seconds', 'Time to compute the map coloring',
+                                        ['metric'])
+REQUESTS_IN_FLIGHT = registry.gauge('dashboard_requests_in_flight', 'Requests being served by this worker')
+WORKER_THREADS = registry.gauge('dashboard_worker_threads', 'Threads serving requests in this worker')
+REQUESTS_AT_CAPACITY = registry.counter('dashboard_requests_at_capacity_total',
+                                        'Requests started while every thread of this worker was busy')
+registry.collected('dashboard_query_cache_hits_total', 'Query helper results found in the query cache', 'counter',
+                   lambda: {(('helper', name),): hits for name, (hits, _) in query_cache.counts().items()})
+registry.collected('dashboard_query_cache_misses_total', 'Query helper results computed on request', 'counter',
+                   lambda: {(('helper', name),): misses for name, (_, misses) in query_cache.counts().items()})
+registry.collected('dashboard_query_cache_entries', 'Results kept in the query cache', 'gauge',
+                   lambda: {(): query_cache.stats()['size']})
+registry.collected('dashboard_fetch_runs_total',
+                   'Fetches run on a FetchPool thread (where="pool") or in the request thread (where="inline")',
+                   'counter', lambda: {(('where', where),): n for where, n in fetch_pool.runs.items()})
+registry.collected('dashboard_cache_warmer_pending', 'Results the cache warmer has still to compute', 'gauge',
+                   lambda: {(): cache_warmer.status()['pending']})
+
+def is_callback_request():
+    return request.path.endswith('/_dash-update-component')
+
+@server.before_request
+def start_metrics():
+    g.metrics_started = time.perf_counter()
+    g.timings_token = metrics.request_timings.set([])
+    REQUESTS_IN_FLIGHT.inc()
+    threads = WORKER_THREADS.samples()
+    if threads and REQUESTS_IN_FLIGHT.samples()[0][2] >= threads[0][2]:
+        REQUESTS_AT_CAPACITY.inc()
+
+@server.after_request
+def observe_callback(response):
+    if is_callback_request() and 'metrics_started' in g:
+        total = time.perf_counter() - g.metrics_started
+        output = (request.get_json(silent=True) or {}).get('output')
+        callback = getattr(app.callback_map.get(output, {}).get('callback'), '__name__', 'unknown')
+        CALLBACK_SECONDS.observe(total, callback=callback)
+        CALLBACK_BYTES.observe(response.calculate_content_length() or 0, callback=callback)
+        # shown per request in the network tab of the browser's developer tools
+        response.headers['Server-Timing'] = metrics.server_timing(metrics.request_timings.get() or [], total)
+    return response
+
+@server.teardown_request
+def finish_metrics(exc):
+    if 'timings_token' in g:
+        metrics.request_timings.reset(g.timings_token)
+        REQUESTS_IN_FLIGHT.dec()
+
+@server.route('/metrics')
+def serve_metrics():
+    return Response(registry.render(), content_type=metrics.CONTENT_TYPE)
 
 
 #########################################
-### BOTTOM PLOT CALLBACKS ###
+### PLOT CALLBACKS ###
 #########################################  
 
-@app.callback(Output('bottom-plot-container', 'children'),
+# Both panels are served by one callback, so their data is fetched once per interaction
+@app.callback(Output('top-plot-container', 'children'),
+              Output('bottom-plot-container', 'children'),
+              Output('top-plot-state', 'data'),
+              Output('bottom-plot-state', 'data'),
               [Input('geojson', 'clickData'),
                Input('year-slider', 'value'),
-               Input('bottom-plot-dropdown', 'value')])
-def update_chart_top(click_data, year_range, dropdown):
+               Input('top-plot-dropdown', 'value'),
+               Input('bottom-plot-dropdown', 'value')],
+              [State('top-plot-state', 'data'),
+               State('bottom-plot-state', 'data'),
+               State('session-id', 'data')])
+def update_charts(click_data, year_range, top_dropdown, bottom_dropdown, top_state, bottom_state, session_id):
+    panels = {'top': top_dropdown, 'bottom': bottom_dropdown}
+    shown = {'top': top_state, 'bottom': bottom_state}
+    # changing one dropdown leaves the other panel as it is
+    if ctx.triggered_id == 'top-plot-dropdown':
+        redraw = ['top']
+    elif ctx.triggered_id == 'bottom-plot-dropdown':
+        redraw = ['bottom']
+    else:
+        redraw = ['top', 'bottom']
+
+    outputs = {panel: no_update for panel in panels}
+    states = {panel: no_update for panel in panels}
     if click_data and 'properties' in click_data and 'ISO_A2' in click_data['properties']:
         country_code = click_data['properties']['ISO_A2']
-        
-        # Plot number of articles per year
-        if dropdown == 'plot_pub_num':
-            pubs_per_year = get_pubs_per_year_per_country(country_code, year_range)
-            fig = px.bar(pubs_per_year, x='Year', y='Articles', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if pubs_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot open access percentage per year
-        if dropdown == 'plot_open_acc':
-            oa_per_year = openacces_per_year_per_country(country_code, year_range)
-            fig = px.bar(oa_per_year, x='Year', y=['Open access', 'Paid access'], orientation='v', template='plotly_white',
-                         color_discrete_map={'Open access': 'black', 'Paid access': 'rgba(0, 0, 0, 0.1)'})
-            fig.update_traces(width=0.5)
-            fig.update_layout(yaxis_title='Articles (%)', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
-                              legend=dict(title='', orientation='h', yanchor='top', y=1.1, xanchor='center', x=0.5))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            fig.for_each_trace(lambda trace: trace.update(hovertemplate=f"<span style='color:{'white' if trace.name == 'Open access' else 'black'}'>"
-                                                                        f"{trace.name}: %{{y}}%</span><extra></extra>"))  
-            if oa_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot Average number of authors per year
-        if dropdown == 'plot_av_auth_num':
-            av_auth_per_year = av_authors_per_year_per_country(country_code, year_range)
-            fig = px.bar(av_auth_per_year, x='Year', y='Average number of authors', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if av_auth_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot Average number of references per year
-        if dropdown == 'plot_av_ref_num':
-            av_ref_per_year = references_per_year_per_country(country_code, year_range)
-            fig = px.bar(av_ref_per_year, x='Year', y='Average number of references', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if av_ref_per_year.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot foreign affiliations percentage per year
-        if dropdown == 'plot_foreign_collabs_perc':
-            df = foreign_collaborators_perc(country_code, year_range)
-            fig = px.bar(df, x='Year', y=['Foreign affiliations', 'Home affiliations'], orientation='v', template='plotly_white',
-                         color_discrete_map={'Foreign affiliations': 'black', 'Home affiliations': 'rgba(0, 0, 0, 0.1)'})
-            fig.update_traces(width=0.5)
-            fig.update_layout(yaxis_title='Affiliations (%)', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
-                              legend=dict(title='', orientation='h', yanchor='top', y=1.1, xanchor='center', x=0.5))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            fig.for_each_trace(lambda trace: trace.update(hovertemplate=f"<span style='color:{'white' if trace.name == 'Foreign affiliations' else 'black'}'>"
-                                                                        f"{trace.name}: %{{y}}%</span><extra></extra>"))  
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        
-        # Plot foreign affiliations countries percentage per year
-        if dropdown == 'plot_foreign_collabs_countries_perc':
-            df = each_foreign_collaborator_perc(country_code, year_range)
-            
-            country_order=df.groupby('country')['value'].aggregate('sum').sort_values(ascending=False)
-            other_idx = [i for i, x in enumerate(country_order.index == 'Other') if x == True][0]
-            country_order2 = country_order.drop('Other')
-            country_order2 = pd.concat((country_order2,country_order.iloc[other_idx:other_idx+1])) # move 'Other' to the end
-            
-            default_colors = px.colors.qualitative.Alphabet  # color scheme
-            color_mapping = {}
-            # Assign colors to other countries dynamically
-            for i, country in enumerate(country_order2.index):
-                if country not in color_mapping:
-                    color_mapping[country] = default_colors[i % len(default_colors)]
-            
-            color_mapping['Other'] = 'black' # Assign black to 'Other'
-
-            fig = px.bar(df, x='Year', y='value', color='country', orientation='v',
-                         template='plotly_white', category_orders={'country': list(color_mapping.keys())},
-                         color_discrete_map=color_mapping, text='country')
-            
-            
-            fig.update_traces(width=0.5)
-            fig.update_layout(yaxis_title='Foreign affiliations (%)', bargap=0.2)
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            
-            #add annotation for downloading high-resolution plot
-            fig.update_layout(annotations=[dict(text='Download in high-resolution', 
-                        xref='paper', yref='paper',
-                        x=1.0, y=1.02, xanchor='right', yanchor='bottom',
-                        showarrow=False,
-                        font=dict(size=12, color='grey'))])
-            
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        # Plot top 15 journals
-        if dropdown == 'plot_top_journals':
-            df = top_journals_ranking(country_code, year_range)
-            fig = px.bar(df.head(15), y='Journal', x='Articles', orientation='h', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(yaxis_title='', bargap=0.2, hoverlabel=dict(font=dict(color='white')),
-                              yaxis=dict(categoryorder='total ascending'),margin=dict(l=0, r=20, t=50, b=50))
-            fig.update_xaxes(title_font=dict(size=14),tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=10), tickfont=dict(size=10), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
-        
-        
-        # Table with top articles
-        if dropdown == 'table_top_articles':
-            df = top_cited_papers(country_code, year_range)
-            df['PMID'] = df['PMID'].apply(lambda x: f'[{x}](https://pubmed.ncbi.nlm.nih.gov/{x}/)')
-            table = dash_table.DataTable(
-            columns=[{'name': col, 'id': col, 'presentation': 'markdown'} for col in df.columns],
-            data=df.to_dict('records'),
-            style_table={'width': '100%', 'height': '400px', 'overflowX': 'auto'},
-            style_header={'backgroundColor': 'grey', 'color': 'white', 'fontSize': 10, 'textAlign': 'center'},
-            style_cell={'textAlign': 'left', 'whiteSpace': 'normal', 'overflow': 'hidden',
-                        'textOverflow': 'ellipsis','maxWidth': '200px', 'maxHeight': '100px'},
-            style_data_conditional=[
-                    {'if': {'column_id': 'Title'}, 'width': '70%'},
-                    {'if': {'column_id': 'Annual citation rate'}, 'width': '10%', 'fontWeight': 'bold'},
-                    {'if': {'column_id': 'PMID'}, 'width': '10%'},
-                    {'if': {'column_id': 'Year'}, 'width': '10%',}],
-            style_data={'fontSize': 10}
-            )
-
-            if df.empty:
-                fig = empty_df_info()
-                return format_dccGraph(fig)
+        # while the slider is dragged only the newest range of each panel is computed
+        tickets = {panel: latest_requests.issue(session_id, f'{panel}-plot') for panel in redraw}
+        with latest_requests.running(tickets.values()):
+            try:
+                bundle = plot_data_bundle(country_code, year_range, [panels[panel] for panel in redraw])
+            except Exception:
+                # queries are interrupted once every redrawn panel has a newer request
+                if latest_requests.superseded(tickets.values()):
+                    raise PreventUpdate
+                raise
+        for panel in redraw:
+            if latest_requests.superseded([tickets[panel]]):
+                continue
+            plot_type = panels[panel]
+            if plot_type in bundle:
+                df = bundle[plot_type]
+                states[panel] = dict(country=country_code, plot=plot_type, patchable=is_patchable(plot_type, df))
+                # a moved slider only patches a figure of the same country and plot type
+                with timed(PLOT_SECONDS, f'figure.{plot_type}', plot_type=plot_type, stage='figure'):
+                    if ctx.triggered_id == 'year-slider' and states[panel]['patchable'] and shown[panel] == states[panel]:
+                        outputs[panel] = patch_plot(plot_type, df, year_range)
+                    else:
+                        outputs[panel] = render_plot(plot_type, df, year_range, f'{panel}-plot')
             else:
-                return table
-
-        # Plot AACR
-        if dropdown == 'plot_aacr':
-            df = aacr_per_year_per_country(country_code, year_range)
-            fig = px.bar(df, x='Publication year', y='Average annual citation rate', orientation='v', template='plotly_white')
-            fig.update_traces(marker_color='grey', width=0.5)
-            fig.update_layout(bargap=0.2, hoverlabel=dict(font=dict(color='white')))
-            fig.update_xaxes(range=[year_range[0]-1, year_range[1]+0.5], title_font=dict(size=14),
-                             tickfont=dict(size=14), tickangle=0, ticks='outside', tickwidth=2.5, tickcolor='rgba(0, 0, 0, 0.1)',)
-            fig.update_yaxes(title_font=dict(size=14), tickfont=dict(size=14), gridcolor='rgba(0, 0, 0, 0.1)', gridwidth=1, griddash='solid')
-            if df.empty:
-                fig = empty_df_info()
-            return format_dccGraph(fig)
+                outputs[panel] = select_prompt(f'{panel}-plot')
+                states[panel] = None
+    else:
+        for panel in redraw:
+            outputs[panel] = select_prompt(f'{panel}-plot')
+            states[panel] = None
 
-        
-    return format_dccGraph(go.Figure(layout=go.Layout(
-        title=dict(text='Click on a country and select plot type', x=0.5, y=0.5, 
-                    xanchor='center', yanchor='top'),
-        template='plotly_white',
-        xaxis=dict(visible=False),
-        yaxis=dict(visible=False)
-    )))
+    return outputs['top'], outputs['bottom'], states['top'], states['bottom']
     
 
 #########################################
 ### CALLBACKS FOR MAP ###
 #########################################
     
-@app.callback(Output('country-name', 'children'), Input('geojson', 'clickData'))
-def display_country_name(click_data):
-    if click_data and 'properties' in click_data and 'NAME' in click_data['properties']:
-        return f'{click_data['properties']['NAME']}'
-    return 'Click on a country to see its name.'
-
-# pop up window for setting lower limit of publications to qualify country
-# for calculation of average number of authors
-@app.callback(
+# Presentation-only callbacks run in the browser, see assets/clientside.js
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='countryName'),
+    Output('country-name', 'children'),
+    Input('geojson', 'clickData')
+)
+
+# swap the country outlines when the zoom crosses into another level of detail
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='mapDetail'),
+    Output('geojson', 'url'),
+    Output('map-level', 'data'),
+    Input('map', 'zoom'),
+    State('map-levels', 'data'),
+    State('map-level', 'data'),
+    prevent_initial_call=True
+)
+
+# input field for the lower limit of publications, shown with the per-country metrics
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='minPapersStyle'),
+    Output('min-papers-info', 'style'),
+    Input('metric-dropdown', 'value')
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='storeMinPapers'),
     Output('stored-min-papers', 'data'),
     Input({'type': 'dynamic-input', 'id': 'min-papers-input'}, 'value'),
     prevent_initial_call=True
 )
-def store_min_papers(value):
-    if value is None or value == '':
-        return 100
-    return value 
 
 @app.callback(
     Output('geojson', 'hideout'),
     Output('colorbar-layer', 'children'),
-    Output('extra-info', 'children'),
+    Output('info-text', 'children'),
     Output('extra-info-top', 'children'),
     [Input('geojson', 'clickData'),
      Input('year-slider', 'value'),
      Input('metric-dropdown', 'value'),
      Input('stored-min-papers', 'data')],
+    State('session-id', 'data'),
     prevent_initial_call=True
 )
-def update_geojson_styles(click_data, year_range, dropdown, min_papers_input):
-    new_styles = {}  # Dictionary to hold styles
+def update_geojson_styles(click_data, year_range, dropdown, min_papers_input, session_id):
+    ticket = latest_requests.issue(session_id, 'map')
+    with latest_requests.running([ticket]), timed(MAP_METRIC_SECONDS, f'map.{dropdown}', metric=dropdown):
+        try:
+            result = map_styles_and_info(click_data, year_range, dropdown, min_papers_input)
+        except Exception:
+            if latest_requests.superseded([ticket]):
+                raise PreventUpdate
+            raise
+    # a newer request is already computing the map
+    if latest_requests.superseded([ticket]):
+        raise PreventUpdate
+    return result
+
+def map_styles_and_info(click_data, year_range, dropdown, min_papers_input):
+    values, min_val, max_val, cmap_name = {}, 0, 1, 'Blues'  # values coloring the map
+    selected_country = None
     extra_info = '\u00A0'
     extra_info_top = '\u00A0'
     colorbar = None
 
 
     if click_data and 'properties' in click_data and 'ISO_A2' in click_data['properties']:
+        # the clicked country is always highlighted
         selected_country = click_data['properties']['ISO_A2']
 
-        # Set the clicked country's style (always applied)
-        new_styles[selected_country] = {
-            'fillColor': 'red',  # Highlight clicked country
-            'fillOpacity': 0.5,
-            'color': 'black',
-            'weight': 2.5
-        }
         #COLLABORATORS MAP
         if dropdown == 'collabs':
-            collab_styles, max_collab, collab_dict = collaborators(selected_country, year_range)
-            new_styles.update(collab_styles)  # Merge the collaboration styles
+            max_collab, collab_dict = collaborators(selected_country, year_range)
+            values, min_val, max_val = collab_dict, 0, max_collab
             
             colorbar = dl.Colorbar(
                 id='colorbar',
@@ -1001,9 +1072,8 @@ def update_geojson_styles(click_data, year_range, dropdown, min_papers_input):
     
     # AVG AUTHORS MAP
     if dropdown == 'avg_authors':
-        avg_authors_styles, min_avg_authors, max_avg_authors, avg_authors_result_dict = avg_number_authors(year_range, min_papers_input)
-        new_styles.update(avg_authors_styles)
-
+        min_avg_authors, max_avg_authors, values = avg_number_authors(year_range, min_papers_input)
+        min_val, max_val = min_avg_authors, max_avg_authors
 
         colorbar = dl.Colorbar(
             id='colorbar',
@@ -1016,30 +1086,16 @@ def update_geojson_styles(click_data, year_range, dropdown, min_papers_input):
             nTicks=int(max_avg_authors) + 2
         )
 
-        # Display the input field for 'avg_authors'
-        extra_info = html.Span([
-            'Include countries with at least ',
-            dcc.Input(
-                id={'type': 'dynamic-input', 'id': 'min-papers-input'},
-                type='number',
-                debounce=True,
-#                placeholder='10',
-                value=min_papers_input,
-                style={'display': 'inline-block', 'width': '60px', 'margin': '0 5px'}
-            ),
-            ' publications in a selected years range (confirm by pressing enter)'
-        ])
+        # the input field for the lower limit is shown instead, see minPapersStyle
+        extra_info = ''
         
         # Display the top extra info
-        try:
-            extra_info_top = avg_authors_result_dict[selected_country]
-        except (NameError, KeyError):
-            extra_info_top = '\u00A0'
+        extra_info_top = values.get(selected_country, '\u00A0')
             
     # AVG REFERENCES MAP
     if dropdown == 'avg_references':
-        avg_references_styles, min_avg_references, max_avg_references, avg_references_result_dict = avg_number_references(year_range, min_papers_input)
-        new_styles.update(avg_references_styles)
+        min_avg_references, max_avg_references, values = avg_number_references(year_range, min_papers_input)
+        min_val, max_val = min_avg_references, max_avg_references
 
         colorbar = dl.Colorbar(
             id='colorbar',
@@ -1052,31 +1108,16 @@ def update_geojson_styles(click_data, year_range, dropdown, min_papers_input):
             nTicks=10
         )
 
-        # Display the input field for 'avg_authors'
-        extra_info = html.Span([
-            'Include countries with at least ',
-            dcc.Input(
-                id={'type': 'dynamic-input', 'id': 'min-papers-input'},
-                type='number',
-                debounce=True,
-#                placeholder='10',
-                value=min_papers_input,
-                style={'display': 'inline-block', 'width': '60px', 'margin': '0 5px'}
-            ),
-            ' publications in a selected years range (confirm by pressing enter)'
-        ])
+        extra_info = ''
         
         # Display the top extra info
-        try:
-            extra_info_top = avg_references_result_dict[selected_country]
-        except (NameError, KeyError):
-            extra_info_top = '\u00A0'
+        extra_info_top = values.get(selected_country, '\u00A0')
             
             
     # OPEN ACCESS PERCENT MAP
     if dropdown == 'open_access':
-        oa_styles, oa_result_dict = open_access_perc(year_range, min_papers_input)
-        new_styles.update(oa_styles)
+        values = open_access_perc(year_range, min_papers_input)
+        min_val, max_val, cmap_name = 0, 100, 'RdBu'
 
         colorbar = dl.Colorbar(
             id='colorbar',
@@ -1089,27 +1130,14 @@ def update_geojson_styles(click_data, year_range, dropdown, min_papers_input):
             nTicks=11
         )
 
-        # Display the input field for 'avg_authors'
-        extra_info = html.Span([
-            'Include countries with at least ',
-            dcc.Input(
-                id={'type': 'dynamic-input', 'id': 'min-papers-input'},
-                type='number',
-                debounce=True,
-#                placeholder='10',
-                value=min_papers_input,
-                style={'display': 'inline-block', 'width': '60px', 'margin': '0 5px'}
-            ),
-            ' publications in a selected years range (confirm by pressing enter)'
-        ])
+        extra_info = ''
         
         # Display the top extra info
-        try:
-            extra_info_top = str(oa_result_dict[selected_country]) + '%'
-        except (NameError, KeyError):
-            extra_info_top = '\u00A0'
+        if selected_country in values:
+            extra_info_top = str(values[selected_country]) + '%'
 
-    return {'styles': new_styles}, colorbar, extra_info, extra_info_top
+    hideout = map_hideout(values, min_val, max_val, cmap_name, selected=selected_country)
+    return hideout, colorbar, extra_info, extra_info_top
 
 
 
@@ -1127,4 +1155,7 @@ def update_geojson_styles(click_data, year_range, dropdown, min_papers_input):
 #     return []
 
 if __name__ == '__main__':
+    problems = check_database(DB_FILE)
+    if problems:
+        raise SystemExit('\n'.join(problems))
     app.run_server(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file
@@ -0,0 +1,42 @@
+// Callbacks run in the browser (registered with app.clientside_callback in app.py):
+// they only rearrange what the page already has, so they need no server request.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    clientside: {
+        // name of the clicked country
+        countryName: function(clickData) {
+            if (clickData && clickData.properties && 'NAME' in clickData.properties) {
+                return clickData.properties.NAME;
+            }
+            return 'Click on a country to see its name.';
+        },
+
+        // the lower limit of publications only applies to the per-country metrics
+        minPapersStyle: function(metric) {
+            const perCountry = ['avg_authors', 'avg_references', 'open_access'];
+            return {display: perCountry.includes(metric) ? 'inline' : 'none'};
+        },
+
+        // an emptied input falls back to the default of 100 publications
+        storeMinPapers: function(value) {
+            if (value === null || value === undefined || value === '') {
+                return 100;
+            }
+            return value;
+        },
+
+        // swap the country outlines when the zoom crosses into another level of detail: the
+        // last of the levels ([{url, min_zoom}] of LEVELS in build_maps.py) the zoom has reached
+        mapDetail: function(zoom, levels, currentLevel) {
+            let level = 0;
+            levels.forEach(function(l, i) {
+                if (zoom !== null && zoom !== undefined && zoom >= l.min_zoom) {
+                    level = i;
+                }
+            });
+            if (level === currentLevel) {
+                return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+            }
+            return [levels[level].url, level];
+        }
+    }
+});
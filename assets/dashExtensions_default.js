@@ -1,9 +1,40 @@
 window.dashExtensions = Object.assign({}, window.dashExtensions, {
     default: {
         function0: function(feature, context) {
+            const hideout = context.hideout || {};
+            const code = feature.properties.ISO_A2;
             // If a style for the country exists in the hideout, use it.
-            if (context.hideout && context.hideout.styles && context.hideout.styles[feature.properties.ISO_A2]) {
-                return context.hideout.styles[feature.properties.ISO_A2];
+            if (hideout.styles && hideout.styles[code]) {
+                return hideout.styles[code];
+            }
+            // Otherwise color raw values on the colorscale, the same 256-step table as get_colors on the server.
+            if (hideout.values && hideout.values[code] != null) {
+                const stops = hideout.colorscale;
+                const [vmin, vmax] = hideout.domain;
+                const t = vmax === vmin ? 0 : (hideout.values[code] - vmin) / (vmax - vmin);
+                const x = Math.min(Math.max(Math.floor(t * 256), 0), 255) / 255 * (stops.length - 1);
+                const i = Math.min(Math.floor(x), stops.length - 2);
+                const channel = (c, k) => parseInt(c.substr(1 + 2 * k, 2), 16);
+                let fill = '#';
+                for (let k = 0; k < 3; k++) {
+                    const v = Math.round(channel(stops[i], k) + (x - i) * (channel(stops[i + 1], k) - channel(stops[i], k)));
+                    fill += v.toString(16).padStart(2, '0');
+                }
+                return {
+                    fillColor: fill,
+                    fillOpacity: 0.8,
+                    color: 'black',
+                    weight: 1
+                };
+            }
+            // Highlight the clicked country.
+            if (hideout.selected === code) {
+                return {
+                    fillColor: 'red',
+                    fillOpacity: 0.5,
+                    color: 'black',
+                    weight: 2.5
+                };
             }
             // Otherwise, return a default style.
             return {
@@ -0,0 +1,160 @@
+'''Micro-benchmarks of the data helpers in app.py.
+
+    python benchmarks/bench_queries.py --db synthetic.db --output results.json
+    python benchmarks/bench_queries.py --db synthetic.db --baseline results.json
+
+Every per-country helper is timed for a huge, a medium and a small producer (the largest
+country, and the ones at 10 % and 50 % of the ranking by papers), over all years and over
+the last five. The map helpers are timed over the same two ranges, and the loading of the
+in-memory tables they read (country_year_sums, ...) a few times. Helpers memoized in the
+query cache are timed without it, i.e. every call queries or aggregates again.
+
+The results are written as JSON with --output. With --baseline, the fastest call of each
+helper (less noisy than the median on a busy machine) is compared with the stored one and
+the exit status is 1 if any helper got slower than --tolerance times the baseline. Compare
+runs on the same machine and database, e.g. one generated with benchmarks/generate_db.py.
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# in-memory tables built on first use
+LOADERS = ['country_year_sums', 'co_affiliations', 'top_cited_lists', 'journal_counts', 'journal_titles',
+           'open_columnar_snapshot']
+
+# helpers(country_code, year_range)
+COUNTRY_HELPERS = ['get_pubs_per_year_per_country', 'openacces_per_year_per_country',
+                   'av_authors_per_year_per_country', 'aacr_per_year_per_country',
+                   'references_per_year_per_country', 'foreign_collaborators_perc',
+                   'each_foreign_collaborator_perc', 'top_journals_ranking', 'top_cited_papers', 'collaborators']
+
+# helpers(year_range, min_records) of the map
+MAP_HELPERS = ['avg_number_authors', 'avg_number_references', 'open_access_perc']
+
+MIN_RECORDS = 100
+
+# differences below this are noise, whatever the ratio
+NOISE_MS = 0.1
+
+
+def load_app(db_file):
+    os.environ['NMR_DB_FILE'] = str(db_file)
+    sys.path.insert(0, str(ROOT))
+    import app
+    return app
+
+
+def benchmark_countries(db_file):
+    '''{size: country} of the huge, medium and small producers.'''
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    ranking = [country for (country,) in conn.execute("""SELECT majority_country FROM country_year_summary
+                                                         WHERE majority_country != 'Multinational'
+                                                         GROUP BY majority_country
+                                                         ORDER BY SUM(n_papers) DESC, majority_country""")]
+    first, last = conn.execute('SELECT MIN(year_pubmed), MAX(year_pubmed) FROM country_year_summary').fetchone()
+    conn.close()
+    countries = {'huge': ranking[0], 'medium': ranking[len(ranking) // 10], 'small': ranking[len(ranking) // 2]}
+    return countries, {'all_years': (first, last), 'last_5_years': (last - 4, last)}
+
+
+def timed(func, args, repeat):
+    '''Milliseconds of repeat calls, after one untimed call.'''
+    func(*args)
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {'median_ms': statistics.median(times), 'min_ms': times[0],
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))]}
+
+
+def run(db_file, repeat):
+    app = load_app(db_file)
+    countries, year_ranges = benchmark_countries(db_file)
+    results = {}
+    for name in LOADERS:
+        results[f'load {name}'] = timed(getattr(app, name).uncached, (), max(1, repeat // 10))
+        # the helpers below read the cached tables
+        getattr(app, name)()
+
+    for name in COUNTRY_HELPERS:
+        helper = getattr(app, name)
+        helper = getattr(helper, 'uncached', helper)
+        for size, country in countries.items():
+            for range_name, year_range in year_ranges.items():
+                results[f'{name} {size} {range_name}'] = timed(helper, (country, year_range), repeat)
+    for name in MAP_HELPERS:
+        for range_name, year_range in year_ranges.items():
+            results[f'{name} {range_name}'] = timed(getattr(app, name), (year_range, MIN_RECORDS), repeat)
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                  text=True).stdout.strip()
+    except OSError:
+        revision = None
+    meta = {'db_file': str(db_file), 'revision': revision, 'countries': countries, 'year_ranges': year_ranges,
+            'repeat': repeat, 'python': platform.python_version(), 'machine': platform.node(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, tolerance):
+    '''Print the ratio of every fastest call to the baseline and return the regressed names.'''
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f'{name:60} {result["min_ms"]:9.3f} ms   (new)')
+            continue
+        ratio = result['min_ms'] / base['min_ms'] if base['min_ms'] else float('inf')
+        slower = ratio > tolerance and result['min_ms'] - base['min_ms'] > NOISE_MS
+        if slower:
+            regressions.append(name)
+        print(f'{name:60} {result["min_ms"]:9.3f} ms {ratio:6.2f}x{"  SLOWER" if slower else ""}')
+    for name in baseline['results'].keys() - results['results'].keys():
+        print(f'{name:60} missing')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the data helpers of the NMR dashboard.')
+    parser.add_argument('--db', default=os.environ.get('NMR_DB_FILE', '/var/data/data.db'), help='compiled data.db')
+    parser.add_argument('--repeat', type=int, default=50, help='timed calls per helper and argument set')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slowdown factor reported as a regression (default: 1.5)')
+    args = parser.parse_args(argv)
+
+    results = run(args.db, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'baseline: revision {baseline["meta"].get("revision")} of {baseline["meta"].get("time")}')
+        regressions = compare(results, baseline, args.tolerance)
+        print(f'{len(regressions)} of {len(results["results"])} slower than {args.tolerance}x the baseline')
+        return 1 if regressions else 0
+    print(f'{"":60} {"median":>9}    {"min":>9}    {"p95":>9}')
+    for name, result in results['results'].items():
+        print(f'{name:60} {result["median_ms"]:9.3f} ms {result["min_ms"]:9.3f} ms {result["p95_ms"]:9.3f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+'''Seeded synthetic data.db for local performance work.
+
+The real database is built by the bibliometrics_NMR_data_prep repository. This script
+writes a `publications` table with the same columns and similar skew instead: a few
+countries produce most papers, output grows over the years, journals and citations
+follow long-tailed distributions, and a share of the values is NULL.
+
+    python benchmarks/generate_db.py synthetic.db                 # 1x, ~ today's NMR corpus
+    python benchmarks/generate_db.py synthetic_10x.db --scale 10 --compile
+    python benchmarks/generate_db.py huge.db --scale 100 --compile
+
+The same seed and scale always give the same database. --compile runs
+`dbtools.py compile` on the result, so that app.py can serve it directly.
+'''
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from aggregates import MULTINATIONAL
+from dbtools import compile_db
+
+
+# papers at scale 1, roughly the size of the NMR corpus in PubMed
+BASE_PAPERS = 250_000
+
+FIRST_YEAR, LAST_YEAR = 1970, 2024
+
+# largest producers first, in about their real order; all other countries on the map follow
+TOP_COUNTRIES = ['US', 'CN', 'DE', 'JP', 'GB', 'FR', 'IN', 'IT', 'KR', 'ES', 'CA', 'PL', 'BR', 'CH', 'AU', 'NL',
+                 'SE', 'RU', 'IL', 'CZ', 'BE', 'AT', 'DK', 'FI', 'IR', 'TW', 'PT', 'MX', 'SG', 'NO']
+
+N_JOURNALS = 2500
+
+COLUMNS = '''pmid INTEGER PRIMARY KEY,
+             title_pubmed TEXT,
+             year_pubmed INTEGER,
+             journal TEXT,
+             journal_title TEXT,
+             majority_country TEXT,
+             countries TEXT,
+             is_open_access INTEGER,
+             authors_number INTEGER,
+             n_references INTEGER,
+             cited_by_count INTEGER,
+             cit_per_year REAL'''
+
+
+def map_countries():
+    with open(ROOT / 'maps' / 'world.geojson') as f:
+        codes = [feature['properties'].get('ISO_A2') for feature in json.load(f)['features']]
+    rest = sorted({code for code in codes if code and code != '-99'} - set(TOP_COUNTRIES))
+    return TOP_COUNTRIES + rest
+
+
+def zipf_weights(n, exponent):
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def with_nulls(rng, values, share):
+    values = values.astype(object)
+    values[rng.random(len(values)) < share] = None
+    return values
+
+
+def generate_chunk(rng, first_pmid, n, countries, country_weights, journal_weights):
+    years = np.arange(FIRST_YEAR, LAST_YEAR + 1)
+    # about 6 % more papers every year
+    year_weights = 1.06 ** (years - FIRST_YEAR)
+    year = rng.choice(years, n, p=year_weights / year_weights.sum())
+    age = LAST_YEAR + 1 - year
+
+    home = rng.choice(len(countries), n, p=country_weights)
+    authors = np.maximum(1, rng.poisson(2 + (year - FIRST_YEAR) / 10, n))
+    # affiliations: mostly home ones, foreign partners drawn with the same skew
+    n_affiliations = np.maximum(1, np.minimum(authors, rng.poisson(3, n)))
+    n_foreign = rng.binomial(n_affiliations, 0.25)
+
+    journal = rng.choice(N_JOURNALS, n, p=journal_weights)
+    cited = np.floor(rng.lognormal(1.5, 1.4, n) * np.sqrt(age)).astype(np.int64)
+    # open access became common only recently, and more so in some countries
+    open_access = rng.random(n) < np.clip(0.05 + 0.5 * (year - 2000) / 25, 0.05, 0.7) * (0.6 + 0.8 * (home % 3) / 2)
+
+    rows = []
+    foreign_pool = rng.choice(len(countries), n_foreign.sum(), p=country_weights)
+    f = 0
+    for i in range(n):
+        affiliations = [countries[home[i]]] * int(n_affiliations[i] - n_foreign[i])
+        affiliations += [countries[c] for c in foreign_pool[f:f + n_foreign[i]]]
+        f += n_foreign[i]
+        counts = {}
+        for country in affiliations:
+            counts[country] = counts.get(country, 0) + 1
+        ranked = sorted(counts.values(), reverse=True)
+        majority = (max(counts, key=counts.get) if len(ranked) == 1 or ranked[0] > ranked[1]
+                    else MULTINATIONAL)
+        rows.append((majority, str(affiliations)))
+
+    authors = with_nulls(rng, authors, 0.02)
+    references = with_nulls(rng, np.maximum(0, rng.normal(35, 15, n)).astype(np.int64), 0.1)
+    open_access = with_nulls(rng, open_access.astype(np.int64), 0.05)
+    cited = with_nulls(rng, cited, 0.03)
+    for i in range(n):
+        pmid = first_pmid + i
+        citations = cited[i]
+        yield (pmid, f'Synthetic NMR study {pmid}', int(year[i]), f'J Synth {journal[i]}',
+               f'Journal of Synthetic Resonance {journal[i]}', rows[i][0], rows[i][1],
+               open_access[i], authors[i], references[i], citations,
+               None if citations is None else citations / int(age[i]))
+
+
+def generate(db_file, scale=1, seed=0, chunk=100_000):
+    n_papers = int(BASE_PAPERS * scale)
+    rng = np.random.default_rng(seed)
+    countries = map_countries()
+    country_weights = zipf_weights(len(countries), 1.3)
+    journal_weights = zipf_weights(N_JOURNALS, 1.1)
+
+    conn = sqlite3.connect(db_file)
+    conn.execute('DROP TABLE IF EXISTS publications')
+    conn.execute(f'CREATE TABLE publications ({COLUMNS})')
+    started = time.monotonic()
+    for first in range(0, n_papers, chunk):
+        n = min(chunk, n_papers - first)
+        with conn:
+            conn.executemany('INSERT INTO publications VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             generate_chunk(rng, first + 1, n, countries, country_weights, journal_weights))
+        print(f'{first + n} of {n_papers} papers ({time.monotonic() - started:.0f} s)', flush=True)
+    conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic publications table.')
+    parser.add_argument('db_file', help='database to write, an existing publications table is replaced')
+    parser.add_argument('--scale', type=float, default=1, help=f'1 = {BASE_PAPERS} papers (default: 1)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compile', action='store_true', help='compile the database for app.py afterwards')
+    args = parser.parse_args(argv)
+    generate(args.db_file, args.scale, args.seed)
+    if args.compile:
+        compile_db(args.db_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+'''Cold-start benchmark: time from launching the server until it answers its first request.
+
+    python benchmarks/startup.py --db /var/data/data.db
+    python benchmarks/startup.py --db data.db --runs 5 --budget 3 --workers 4
+
+Every run starts gunicorn with gunicorn.conf.py (the Dockerfile's command) on a free
+port and polls the dashboard page, then the layout and one map callback, until they
+answer. The median time to the first page is compared with the budget (seconds, also
+read from STARTUP_BUDGET), and the exit status is 1 when it is exceeded, so the script
+can run as a deployment check.
+'''
+
+import argparse
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_BUDGET = 5.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, deadline, data=None):
+    '''Wait until url answers with 200, polling every 10 ms.'''
+    while time.perf_counter() < deadline:
+        try:
+            request = urllib.request.Request(url, data, {'Content-Type': 'application/json'} if data else {})
+            with urllib.request.urlopen(request, timeout=deadline - time.perf_counter()) as response:
+                response.read()
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.01)
+    raise TimeoutError(f'no answer from {url}')
+
+
+def map_callback(base):
+    '''Body of the map coloring callback, the first one the browser sends to the server
+    (zooming and the country name are handled in the browser), read from the dependencies
+    the app serves.'''
+    with urllib.request.urlopen(base + '/_dash-dependencies') as response:
+        dependencies = json.load(response)
+    callback = next(d for d in dependencies if 'geojson.hideout' in d['output'].strip('.').split('...')
+                    and not d.get('clientside_function'))
+    outputs = [dict(zip(('id', 'property'), o.split('.'))) for o in callback['output'].strip('.').split('...')]
+    # no country clicked and no coloring, i.e. the map as the page shows it first
+    values = {'year-slider': [2000, 2024], 'metric-dropdown': 'nocolors', 'stored-min-papers': 100}
+    return json.dumps({'output': callback['output'], 'outputs': outputs,
+                       'inputs': [dict(i, value=values.get(i['id'])) for i in callback['inputs']],
+                       'state': [dict(s, value=None) for s in callback['state']],
+                       'changedPropIds': ['metric-dropdown.value']}).encode()
+
+
+def run_once(db_file, workers, timeout):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, NMR_DB_FILE=str(db_file), BIND=f'127.0.0.1:{port}', WEB_CONCURRENCY=str(workers))
+    log = tempfile.TemporaryFile()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:server'], cwd=ROOT, env=env,
+                              stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = started + timeout
+        wait_for(base + '/', deadline)
+        first_page = time.perf_counter() - started
+        wait_for(base + '/_dash-layout', deadline)
+        layout = time.perf_counter() - started
+        wait_for(base + '/_dash-update-component', deadline, map_callback(base))
+        callback = time.perf_counter() - started
+    except TimeoutError:
+        log.seek(0)
+        print(log.read().decode()[-2000:], file=sys.stderr)
+        raise
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+    return first_page, layout, callback
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the time until a fresh dashboard server answers.')
+    parser.add_argument('--db', default=os.environ.get('NMR_DB_FILE', '/var/data/data.db'), help='compiled data.db')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--budget', type=float, default=float(os.environ.get('STARTUP_BUDGET', DEFAULT_BUDGET)),
+                        help=f'seconds allowed until the first page (default: {DEFAULT_BUDGET})')
+    parser.add_argument('--timeout', type=float, default=60, help='give up on a run after this many seconds')
+    args = parser.parse_args(argv)
+
+    results = []
+    for run in range(args.runs):
+        first_page, layout, callback = run_once(args.db, args.workers, args.timeout)
+        results.append(first_page)
+        print(f'run {run + 1}: first page {first_page:.2f} s, layout {layout:.2f} s, map callback {callback:.2f} s')
+
+    median = statistics.median(results)
+    ok = median <= args.budget
+    print(f'median time to first page {median:.2f} s, budget {args.budget:.2f} s: {"ok" if ok else "EXCEEDED"}')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
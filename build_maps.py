@@ -0,0 +1,278 @@
+'''Build the simplified world maps shown by the dashboard.
+
+maps/world.geojson keeps the full-precision country outlines. The dashboard does not
+need them at low zoom, so this script writes one simplified copy per level of detail:
+
+    python build_maps.py                      # maps/world.geojson -> maps/world_lod{0,1,2}.geojson
+    python build_maps.py other.geojson -d out
+
+Every level is also written gzip- and brotli-compressed (world_lod0.geojson.gz, .br) so
+that app.py can serve the compressed bytes as they are. Brotli is skipped when the
+brotli package is not installed.
+
+Borders shared by two countries are simplified only once (the outlines are first cut
+into arcs at the points where neighbouring countries meet, the same way TopoJSON does),
+so neighbours keep a common border without gaps or overlaps at every level. Coordinates
+are then rounded to the precision that is visible at the zoom range of the level.
+'''
+
+import argparse
+import gzip
+import json
+import math
+import sys
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+SOURCE = Path(__file__).parent / 'maps' / 'world.geojson'
+
+# (first zoom level the file is used at, simplification tolerance in degrees, decimals kept)
+LEVELS = [
+    (0, 0.25, 2),
+    (3, 0.05, 3),
+    (5, 0, 4),
+]
+
+# Feature properties read by the dashboard, all other properties are dropped
+PROPERTIES = ('NAME', 'ISO_A2')
+
+
+# Content-Encoding -> suffix of the precompressed file, in order of preference
+ENCODINGS = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+
+def level_file(level, directory=SOURCE.parent):
+    return Path(directory) / f'world_lod{level}.geojson'
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # mtime=0 keeps the output identical between builds
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+#########################################
+### SHARED ARCS ###
+#########################################
+
+def feature_polygons(feature):
+    '''Polygons of a feature as lists of rings, each ring a list of (x, y) tuples without
+    the closing point.'''
+    geometry = feature['geometry']
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    result = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            points = [tuple(p[:2]) for p in ring]
+            if len(points) > 1 and points[0] == points[-1]:
+                points.pop()
+            # drop repeated vertices, they would look like junctions
+            points = [p for i, p in enumerate(points) if p != points[i - 1]] if len(points) > 1 else points
+            rings.append(points)
+        result.append(rings)
+    return result
+
+
+def find_junctions(rings):
+    '''Points where a ring meets a different neighbour than at another occurrence of the
+    same point, i.e. where a shared border starts or ends.'''
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, p in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+            seen = neighbours.setdefault(p, pair)
+            if seen != pair:
+                junctions.add(p)
+    return junctions
+
+
+def split_ring(ring, junctions):
+    '''Cut a ring into arcs at its junctions. A ring without junctions becomes one closed
+    arc, rotated to start at its smallest point so that identical rings match.'''
+    cuts = [i for i, p in enumerate(ring) if p in junctions]
+    if not cuts:
+        start = ring.index(min(ring))
+        closed = ring[start:] + ring[:start]
+        return [closed + [closed[0]]]
+    rotated = ring[cuts[0]:] + ring[:cuts[0]]
+    offsets = [i - cuts[0] for i in cuts] + [len(ring)]
+    rotated.append(rotated[0])
+    return [rotated[a:b + 1] for a, b in zip(offsets, offsets[1:])]
+
+
+class Topology:
+    '''Rings of all features as sequences of references into a list of unique arcs.
+    A reference ~i means arc i walked backwards.'''
+
+    def __init__(self, features):
+        self.features = features
+        self.polygons = [feature_polygons(f) for f in features]
+        junctions = find_junctions([ring for polygons in self.polygons for polygon in polygons for ring in polygon])
+        self.arcs = []
+        index = {}
+        self.rings = []
+        for polygons in self.polygons:
+            feature_rings = []
+            for polygon in polygons:
+                polygon_refs = []
+                for ring in polygon:
+                    refs = []
+                    for arc in split_ring(ring, junctions):
+                        key = tuple(arc)
+                        if key in index:
+                            refs.append(index[key])
+                        elif key[::-1] in index:
+                            refs.append(~index[key[::-1]])
+                        else:
+                            index[key] = len(self.arcs)
+                            refs.append(len(self.arcs))
+                            self.arcs.append(arc)
+                    polygon_refs.append(refs)
+                feature_rings.append(polygon_refs)
+            self.rings.append(feature_rings)
+
+
+#########################################
+### SIMPLIFICATION ###
+#########################################
+
+def point_segment_distance(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0, min(1, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def douglas_peucker(points, tolerance):
+    '''Douglas-Peucker simplification keeping both end points.'''
+    if len(points) < 3:
+        return list(points)
+    if points[0] == points[-1]:
+        # closed arc: split at the point farthest from the start and simplify both halves
+        far = max(range(len(points)), key=lambda i: math.hypot(points[i][0] - points[0][0],
+                                                                points[i][1] - points[0][1]))
+        return douglas_peucker(points[:far + 1], tolerance)[:-1] + douglas_peucker(points[far:], tolerance)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        best, best_i = 0, None
+        for i in range(first + 1, last):
+            d = point_segment_distance(points[i], points[first], points[last])
+            if d > best:
+                best, best_i = d, i
+        if best_i is not None and best > tolerance:
+            keep[best_i] = True
+            stack.append((first, best_i))
+            stack.append((best_i, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def quantize(points, decimals):
+    '''Round coordinates and drop the vertices that collapse onto their predecessor.'''
+    result = []
+    for x, y in points:
+        p = (round(x, decimals), round(y, decimals))
+        if not result or p != result[-1]:
+            result.append(p)
+    return result
+
+
+def ring_area(ring):
+    return abs(sum(a[0] * b[1] - b[0] * a[1] for a, b in zip(ring, ring[1:]))) / 2
+
+
+def assemble_ring(refs, arcs):
+    ring = []
+    for ref in refs:
+        arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+        ring.extend(arc if not ring else arc[1:])
+    return [list(p) for p in ring]
+
+
+def is_valid_ring(ring):
+    # a closed ring needs three distinct points and a non-zero area
+    return len(ring) >= 4 and ring_area(ring) > 0
+
+
+def simplify(topology, tolerance, decimals):
+    '''GeoJSON features with every shared arc simplified and quantized once. Rings that
+    degenerate are dropped, but every country keeps at least its largest polygon.'''
+    arcs = [quantize(douglas_peucker(arc, tolerance), decimals) for arc in topology.arcs]
+    features = []
+    for feature, polygons_refs, polygons in zip(topology.features, topology.rings, topology.polygons):
+        coordinates = []
+        for refs, original in zip(polygons_refs, polygons):
+            exterior = assemble_ring(refs[0], arcs)
+            if not is_valid_ring(exterior):
+                continue
+            holes = [ring for ring in (assemble_ring(r, arcs) for r in refs[1:]) if is_valid_ring(ring)]
+            coordinates.append([exterior] + holes)
+        if not coordinates:
+            # too small for this level, keep the largest polygon only rounded
+            largest = max(polygons, key=lambda rings: ring_area(rings[0] + rings[0][:1]))
+            exterior = quantize(largest[0] + largest[0][:1], decimals)
+            if not is_valid_ring(exterior):
+                exterior = [list(p) for p in largest[0] + largest[0][:1]]
+            coordinates.append([[list(p) for p in exterior]])
+        geometry = ({'type': 'Polygon', 'coordinates': coordinates[0]} if len(coordinates) == 1
+                    else {'type': 'MultiPolygon', 'coordinates': coordinates})
+        properties = {k: feature['properties'][k] for k in PROPERTIES if k in feature['properties']}
+        features.append({'type': 'Feature', 'properties': properties, 'geometry': geometry})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+#########################################
+### COMMANDS ###
+#########################################
+
+def build_maps(source=SOURCE, directory=None):
+    with open(source) as f:
+        world = json.load(f)
+    topology = Topology(world['features'])
+    n_shared = sum(1 for arc in topology.arcs if arc[0] != arc[-1])
+    print(f'{len(topology.arcs)} arcs ({n_shared} between junctions) '
+          f'from {len(world["features"])} features')
+    directory = Path(directory or Path(source).parent)
+    directory.mkdir(parents=True, exist_ok=True)
+    for level, (min_zoom, tolerance, decimals) in enumerate(LEVELS):
+        path = level_file(level, directory)
+        data = json.dumps(simplify(topology, tolerance, decimals), separators=(',', ':')).encode()
+        path.write_bytes(data)
+        sizes = [f'{len(data) / 1e3:.0f} kB']
+        for encoding, suffix in ENCODINGS.items():
+            compressed = path.with_name(path.name + suffix)
+            if encoding == 'br' and brotli is None:
+                # never leave a variant of an older build next to the new file
+                compressed.unlink(missing_ok=True)
+                continue
+            compressed.write_bytes(compress(data, encoding))
+            sizes.append(f'{encoding} {compressed.stat().st_size / 1e3:.0f} kB')
+        print(f'{path}: zoom >= {min_zoom}, ' + ', '.join(sizes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write simplified world maps for the NMR dashboard.')
+    parser.add_argument('source', nargs='?', default=SOURCE, help='full-precision GeoJSON (default: maps/world.geojson)')
+    parser.add_argument('-d', '--directory', help='output directory (default: next to the source)')
+    args = parser.parse_args(argv)
+    build_maps(args.source, args.directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+'''Memory-mapped columnar snapshot of `publications`.
+
+`python dbtools.py export-columns data.db` writes the numeric columns of the papers as
+.npy files into data.columns/ next to the database, sorted by country and year:
+
+    meta.json             countries (the dictionary of the country codes), fingerprint
+    country_offsets.npy   papers of countries[i] are rows country_offsets[i]:country_offsets[i + 1]
+    country.npy           dictionary-encoded majority_country of each paper
+    year_pubmed.npy
+    is_open_access.npy, authors_number.npy, ...   float64, NaN for NULL
+    summary_offsets.npy   rows of countries[i] in year_summaries.npy, like country_offsets
+    year_summaries.npy    int64 rows of country_year_summary (the fields of YearSummary),
+                          sorted by country and year, 0 for NULL sums
+
+app.py opens the files with mmap_mode='r', so all worker processes read the same pages
+of the OS page cache instead of each keeping its own copy. The per-year plots read the
+precomputed year_summaries, which is small, rather than summing up the papers on every call.
+'''
+
+import json
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+
+MEASURES = ('is_open_access', 'authors_number', 'n_references', 'cited_by_count', 'cit_per_year')
+
+# one row of country_year_summary (see dbtools.build_country_year_summary)
+YearSummary = namedtuple('YearSummary', ['year', 'n_papers', 'n_open_access', 'n_open_access_known',
+                                         'sum_authors', 'n_authors_known', 'sum_references',
+                                         'n_references_known', 'sum_citations'])
+
+
+def snapshot_directory(db_file):
+    return Path(db_file).with_suffix('.columns')
+
+
+def fingerprint(conn):
+    '''Identifies the data of a compiled database; a snapshot is only used with the database
+    it was exported from.'''
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    n_papers, citations = conn.execute('SELECT SUM(n_papers), SUM(sum_citations) FROM country_year_summary').fetchone()
+    return [version, n_papers, citations]
+
+
+# rows fetched at a time by export_columns, so the export never holds the whole table
+EXPORT_BATCH = 100_000
+
+
+def export_columns(conn, directory, batch=EXPORT_BATCH):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    where = 'WHERE majority_country IS NOT NULL AND year_pubmed IS NOT NULL'
+    # one read transaction, so the count and the rows are of the same data
+    conn.execute('BEGIN')
+    try:
+        n_rows = conn.execute(f'SELECT COUNT(*) FROM publications {where}').fetchone()[0]
+        # written in place batch by batch, every column memory-mapped
+        country = np.lib.format.open_memmap(directory / 'country.npy', 'w+', np.uint16, (n_rows,))
+        year = np.lib.format.open_memmap(directory / 'year_pubmed.npy', 'w+', np.int16, (n_rows,))
+        measures = [np.lib.format.open_memmap(directory / f'{column}.npy', 'w+', np.float64, (n_rows,))
+                    for column in MEASURES]
+        cursor = conn.execute(f'''SELECT majority_country, year_pubmed, {", ".join(MEASURES)} FROM publications
+                                 {where} ORDER BY majority_country, year_pubmed''')
+        # rows come sorted by country, so each new country gets the next index
+        countries, index, start = [], {}, 0
+        while rows := cursor.fetchmany(batch):
+            end = start + len(rows)
+            for row in rows:
+                if row[0] not in index:
+                    index[row[0]] = len(countries)
+                    countries.append(row[0])
+            country[start:end] = [index[row[0]] for row in rows]
+            year[start:end] = [row[1] for row in rows]
+            for i, values in enumerate(measures, start=2):
+                # None becomes NaN
+                values[start:end] = np.array([row[i] for row in rows], dtype=np.float64)
+            start = end
+        for values in [country, year] + measures:
+            values.flush()
+        np.save(directory / 'country_offsets.npy', np.searchsorted(country, np.arange(len(countries) + 1)))
+        # the same countries (papers with a country and a year), in the same order
+        summaries = conn.execute('''SELECT majority_country, year_pubmed, n_papers,
+                                           COALESCE(n_open_access, 0), n_open_access_known,
+                                           COALESCE(sum_authors, 0), n_authors_known,
+                                           COALESCE(sum_references, 0), n_references_known, sum_citations
+                                    FROM country_year_summary
+                                    ORDER BY majority_country, year_pubmed''').fetchall()
+        summary_country = np.array([index[row[0]] for row in summaries], dtype=np.int64)
+        np.save(directory / 'summary_offsets.npy', np.searchsorted(summary_country, np.arange(len(countries) + 1)))
+        np.save(directory / 'year_summaries.npy',
+                np.array([row[1:] for row in summaries], dtype=np.int64).reshape(-1, len(YearSummary._fields)))
+        # written last: a snapshot without meta.json is incomplete and never loaded
+        with open(directory / 'meta.json', 'w') as f:
+            json.dump({'countries': countries, 'fingerprint': fingerprint(conn)}, f)
+    finally:
+        conn.execute('COMMIT')
+    return n_rows
+
+
+class ColumnarSnapshot:
+    '''Read-only view of an exported snapshot.'''
+
+    def __init__(self, directory):
+        directory = Path(directory)
+        with open(directory / 'meta.json') as f:
+            meta = json.load(f)
+        self.fingerprint = meta['fingerprint']
+        self.index = {country: i for i, country in enumerate(meta['countries'])}
+        self.offsets = np.load(directory / 'country_offsets.npy')
+        self.year = np.load(directory / 'year_pubmed.npy', mmap_mode='r')
+        self.columns = {column: np.load(directory / f'{column}.npy', mmap_mode='r') for column in MEASURES}
+        self.summary_offsets = np.load(directory / 'summary_offsets.npy')
+        self.summaries = np.load(directory / 'year_summaries.npy', mmap_mode='r')
+
+    @classmethod
+    def open(cls, directory, conn):
+        '''The snapshot in directory, or None if there is none or it was exported from
+        other data than the database of conn.'''
+        if not (Path(directory) / 'meta.json').exists():
+            return None
+        snapshot = cls(directory)
+        if snapshot.fingerprint != fingerprint(conn):
+            print(f'{directory} was exported from another database, run: python dbtools.py export-columns')
+            return None
+        return snapshot
+
+    def year_summaries(self, country, year_range):
+        '''The country_year_summary rows of the country in year_range, latest year first.'''
+        c = self.index.get(country)
+        if c is None:
+            return []
+        rows = self.summaries[self.summary_offsets[c]:self.summary_offsets[c + 1]]
+        start = np.searchsorted(rows[:, 0], int(year_range[0]), side='left')
+        end = np.searchsorted(rows[:, 0], int(year_range[1]), side='right')
+        return [YearSummary(*row) for row in rows[start:end][::-1].tolist()]
@@ -0,0 +1,663 @@
+'''Read-only SQLite access for the dashboard.
+
+Each thread serving callbacks gets its own connection, so concurrent clicks run their
+queries in parallel instead of sharing one connection and cursor. Results of the query
+helpers are memoized in a QueryCache shared by all callbacks.
+
+Callbacks whose result has been superseded by a newer request of the same browser session
+(e.g. while the year slider is dragged) are detected with LatestRequests, and their
+running queries are aborted by the connection's progress handler.
+
+After a deploy or a database refresh the cache is refilled in the background by a
+CacheWarmer, starting with the default views and then the calls visitors make most often.
+
+Independent fetches of one request (e.g. the data of both plot panels) run side by side
+on the few threads of a FetchPool, each with its own connection.
+
+Every statement can be timed by the connections themselves (ConnectionPool's
+`on_statement`), e.g. to write the slow ones to a SlowQueryLog with their query plan.
+'''
+
+import contextvars
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+
+# Tickets (see LatestRequests) of the callback running in the current thread
+current_tickets = contextvars.ContextVar('current_tickets', default=())
+
+# Name of the query helper QueryCache is computing in the current thread, if any
+current_helper = contextvars.ContextVar('current_helper', default=None)
+
+
+class ConnectionPool:
+    '''Per-thread read-only connections to one database file.
+
+    `cancelled` is polled every `progress_steps` SQLite VM instructions while a query runs;
+    when it returns True the query fails with sqlite3.OperationalError('interrupted').
+
+    With `immutable` SQLite takes no file locks and skips change detection. Only use it when
+    a refreshed database replaces the file (a new inode) instead of writing into it.
+
+    Connections are only opened on first use in each thread, so a pool created before a
+    fork (gunicorn --preload) holds no connection the workers would share.
+
+    With `on_statement` every statement is timed from its execute until its last row has
+    been fetched, and on_statement(conn, statement) is called with a Statement.'''
+
+    def __init__(self, db_file, mmap_size=256 * 1024**2, cache_size_kib=64 * 1024, cached_statements=256,
+                 cancelled=None, progress_steps=5000, immutable=False, on_statement=None):
+        self.db_file = db_file
+        self.immutable = immutable
+        self.on_statement = on_statement
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.cached_statements = cached_statements
+        self.cancelled = cancelled
+        self.progress_steps = progress_steps
+        self.generation = 0
+        self._local = threading.local()
+
+    def _open(self):
+        # mode=ro: the dashboard never writes, which also lets readers run alongside a
+        # writer when the database is in WAL mode
+        uri = Path(self.db_file).absolute().as_uri() + '?mode=ro' + ('&immutable=1' if self.immutable else '')
+        factory = sqlite3.Connection if self.on_statement is None else TimedConnection
+        conn = sqlite3.connect(uri, uri=True, cached_statements=self.cached_statements, factory=factory)
+        if self.on_statement is not None:
+            conn.on_statement = self.on_statement
+            conn.progress_steps = self.progress_steps
+        conn.execute('PRAGMA query_only = ON')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kib)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        if self.on_statement is not None:
+            conn.set_progress_handler(conn.progress(self.cancelled), self.progress_steps)
+        elif self.cancelled is not None:
+            conn.set_progress_handler(self.cancelled, self.progress_steps)
+        return conn
+
+    def connection(self):
+        '''Connection of the calling thread, opened on first use.'''
+        local = self._local
+        if getattr(local, 'generation', None) != self.generation:
+            if getattr(local, 'conn', None) is not None:
+                local.conn.close()
+            local.conn = self._open()
+            local.generation = self.generation
+        return local.conn
+
+    def reset(self):
+        '''Make every thread reopen its connection on next use, e.g. after the database
+        file has been replaced or in a newly forked worker.'''
+        self.generation += 1
+
+    def close(self):
+        '''Close the connection of the calling thread, e.g. in a process about to fork.'''
+        local = self._local
+        if getattr(local, 'conn', None) is not None:
+            local.conn.close()
+        local.conn, local.generation = None, None
+
+    def schema_version(self):
+        return self.connection().execute('PRAGMA user_version').fetchone()[0]
+
+
+class Statement:
+    '''One statement run by a TimedConnection: seconds spent in execute and fetching its
+    rows, and the approximate SQLite VM steps (counted every `progress_steps`).'''
+
+    def __init__(self, sql, params, vm_steps_before):
+        self.sql = sql
+        self.params = params
+        self.helper = current_helper.get()
+        self.seconds = 0.0
+        self.rows = 0
+        self.vm_steps = -vm_steps_before
+        self.error = None
+
+
+class TimedCursor(sqlite3.Cursor):
+    '''Cursor timing its statements, see TimedConnection.'''
+
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        self.statement = Statement(sql, parameters, self.connection.vm_steps)
+        return self._timed(super().execute, sql, parameters)
+
+    def _timed(self, method, *args):
+        statement = self.statement
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        except sqlite3.Error as e:
+            if statement is not None:
+                statement.error = str(e)
+            raise
+        finally:
+            if statement is not None:
+                statement.seconds += time.perf_counter() - started
+                if statement.error is not None:
+                    self.finish()
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._count(len(rows), True)
+        return rows
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        self._count(len(rows), len(rows) < size)
+        return rows
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        self._count(row is not None, row is None)
+        return row
+
+    def __iter__(self):
+        # the rows of the for loop are counted, the time between them is the caller's
+        fetch = super().fetchmany
+        while True:
+            rows = self._timed(fetch, 256)
+            self._count(len(rows), len(rows) < 256)
+            yield from rows
+            if len(rows) < 256:
+                return
+
+    def _count(self, rows, done):
+        if self.statement is not None:
+            self.statement.rows += rows
+            if done:
+                self.finish()
+
+    def finish(self):
+        '''Report the statement, once all rows have been fetched or when the cursor is
+        closed, reused or dropped before.'''
+        statement, self.statement = self.statement, None
+        if statement is not None:
+            conn = self.connection
+            statement.vm_steps += conn.vm_steps
+            conn.on_statement(conn, statement)
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+
+class TimedConnection(sqlite3.Connection):
+    '''Connection whose cursors (also of execute and pandas.read_sql) time their statements.'''
+
+    on_statement = None
+    progress_steps = 1
+    progress_calls = 0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # sqlite3.Connection.execute does not go through cursor()
+        return self.cursor().execute(sql, parameters)
+
+    @property
+    def vm_steps(self):
+        return self.progress_calls * self.progress_steps
+
+    def progress(self, cancelled=None):
+        '''Progress handler counting VM steps, and aborting the statement when cancelled().'''
+        def handler():
+            self.progress_calls += 1
+            return cancelled is not None and cancelled()
+        return handler
+
+    def query_plan(self, sql, params=()):
+        '''Lines of EXPLAIN QUERY PLAN indented like the sqlite3 shell shows them, run with
+        a plain cursor so that it is not timed itself.'''
+        lines, depth = [], {}
+        for node, parent, _, detail in sqlite3.Cursor(self).execute('EXPLAIN QUERY PLAN ' + sql, params):
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append('  ' * depth[node] + detail)
+        return lines
+
+
+class SlowQueryLog:
+    '''Statements of a TimedConnection slower than `threshold` seconds, written as JSON
+    lines to a rotating file together with their query plan at that moment.
+
+    '{pid}' in `path` is replaced by the id of the process writing, so that every gunicorn
+    worker rotates a file of its own. The file is only opened when the first slow
+    statement is written.'''
+
+    def __init__(self, path, threshold, max_bytes=10 * 1024**2, backup_count=5):
+        self.path = path
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handler = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # a new file in a forked worker, the parent's handler is left alone
+            handler = logging.handlers.RotatingFileHandler(
+                str(self.path).format(pid=pid), maxBytes=self.max_bytes, backupCount=self.backup_count,
+                encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._handler, self._pid = handler, pid
+        return self._handler
+
+    def __call__(self, conn, statement):
+        if statement.seconds < self.threshold:
+            return
+        try:
+            plan = conn.query_plan(statement.sql, statement.params)
+        except sqlite3.Error as e:
+            plan = f'not available: {e}'
+        params = statement.params
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'pid': os.getpid(),
+                  'helper': statement.helper, 'seconds': round(statement.seconds, 6),
+                  'rows': statement.rows, 'vm_steps': statement.vm_steps, 'error': statement.error,
+                  'sql': ' '.join(statement.sql.split()),
+                  'params': dict(params) if isinstance(params, dict) else list(params), 'plan': plan}
+        with self._lock:
+            self._open().emit(logging.makeLogRecord({'msg': json.dumps(record, default=str)}))
+
+
+class QueryCache:
+    '''Size-bounded LRU cache of query helper results.
+
+    Entries are keyed by (function, arguments) and the whole cache is dropped when the
+    modification time or schema version of the database changes. The number of requests
+    of every key is kept across refreshes, see hot_calls.
+
+    Helpers memoized with memoize_per_db (in-memory tables built from the whole database)
+    are kept apart from the LRU, so that per-call results never evict them; they are only
+    dropped with the database, not by clear().
+    '''
+
+    def __init__(self, pool, maxsize=1024, on_compute=None):
+        self.pool = pool
+        self.maxsize = maxsize
+        # called with (function name, seconds) after computing a missed result
+        self.on_compute = on_compute
+        self.hits = Counter()
+        self.misses = Counter()
+        self.requests = Counter()
+        self._calls = {}
+        self._data = OrderedDict()
+        self._per_db = {}
+        self._lock = threading.Lock()
+        self._stat = None
+        self._token = None
+
+    def _check_db(self):
+        st = os.stat(self.pool.db_file)
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat == self._stat:
+            return
+        with self._lock:
+            if stat == self._stat:
+                return
+            if self._stat is not None:
+                # a refreshed file may be a new inode, so the open connections are stale too
+                self.pool.reset()
+            token = (stat, self.pool.schema_version())
+            if token != self._token:
+                self._data.clear()
+                self._per_db.clear()
+            self._stat, self._token = stat, token
+
+    @staticmethod
+    def _key(func, args):
+        # year ranges come from the slider as lists
+        return (func.__name__,) + tuple(tuple(x) if isinstance(x, list) else x for x in args)
+
+    def get(self, func, *args):
+        '''Result of func(*args), computed on a miss. Callers get their own copy, so they
+        may modify returned DataFrames and dicts.'''
+        self._check_db()
+        key = self._key(func, args)
+        with self._lock:
+            self._log_request(key, func, args)
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits[func.__name__] += 1
+                return copy.deepcopy(self._data[key])
+            self.misses[func.__name__] += 1
+
+        started = time.perf_counter()
+        result = self._compute(func, args)
+        if self.on_compute is not None:
+            self.on_compute(func.__name__, time.perf_counter() - started)
+        self._store(key, result)
+        return copy.deepcopy(result)
+
+    @staticmethod
+    def _compute(func, args):
+        # statements of the helper are attributed to it, see Statement
+        token = current_helper.set(func.__name__)
+        try:
+            return func(*args)
+        finally:
+            current_helper.reset(token)
+
+    def _log_request(self, key, func, args):
+        self.requests[key] += 1
+        self._calls[key] = (func, args)
+        if len(self.requests) > 10 * self.maxsize:
+            # forget the rarely requested keys
+            self.requests = Counter(dict(self.requests.most_common(self.maxsize)))
+            self._calls = {k: self._calls[k] for k in self.requests}
+
+    def _store(self, key, result):
+        with self._lock:
+            self._data[key] = result
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_per_db(self, func, *args):
+        '''Result of func(*args), computed once per database file. All callers get the
+        same object, so it must never be modified.'''
+        self._check_db()
+        key = self._key(func, args)
+        with self._lock:
+            if key in self._per_db:
+                self.hits[func.__name__] += 1
+                return self._per_db[key]
+            self.misses[func.__name__] += 1
+
+        result, seconds = self._build_per_db(func, args)
+        if self.on_compute is not None:
+            self.on_compute(func.__name__, seconds)
+        return result
+
+    def _build_per_db(self, func, args):
+        started = time.perf_counter()
+        result = self._compute(func, args)
+        seconds = time.perf_counter() - started
+        # rare and slow, so every build is logged with the process that made it
+        print(f'Built {func.__name__} in {seconds:.2f} s (pid {os.getpid()})', flush=True)
+        with self._lock:
+            # threads that built it at the same time all get the first result
+            return self._per_db.setdefault(self._key(func, args), result), seconds
+
+    def contains(self, func, *args):
+        self._check_db()
+        with self._lock:
+            store = self._per_db if getattr(func, 'per_db', False) else self._data
+            return self._key(getattr(func, 'uncached', func), args) in store
+
+    def warm(self, func, *args):
+        '''Compute and store func(*args) unless cached, without counting a hit or miss.
+        Returns True if the result was computed.'''
+        if self.contains(func, *args):
+            return False
+        if getattr(func, 'per_db', False):
+            self._build_per_db(func.uncached, args)
+            return True
+        func = getattr(func, 'uncached', func)
+        self._store(self._key(func, args), self._compute(func, args))
+        return True
+
+    def hot_calls(self, n, min_requests=2):
+        '''(function, args) of the n most requested keys.'''
+        with self._lock:
+            return [self._calls[key] for key, count in self.requests.most_common(n) if count >= min_requests]
+
+    def memoize(self, func):
+        @wraps(func)
+        def wrapper(*args):
+            return self.get(func, *args)
+        wrapper.uncached = func
+        return wrapper
+
+    def memoize_per_db(self, func):
+        '''Like memoize, but all callers get the same object, kept outside the LRU until
+        the database file changes, e.g. for lookup structures built from whole tables that
+        are never modified.'''
+        @wraps(func)
+        def wrapper(*args):
+            return self.get_per_db(func, *args)
+        wrapper.uncached = func
+        wrapper.per_db = True
+        return wrapper
+
+    def clear(self):
+        '''Drop the per-call results, the memoize_per_db ones are kept.'''
+        with self._lock:
+            self._data.clear()
+
+    def reset_counts(self):
+        '''Start the hit and miss counts over, e.g. in a forked worker.'''
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+    def counts(self):
+        '''{function name: (hits, misses)} since start'''
+        with self._lock:
+            return {name: (self.hits[name], self.misses[name]) for name in self.hits.keys() | self.misses.keys()}
+
+    def stats(self):
+        with self._lock:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'per_db': len(self._per_db),
+                    'hits': hits, 'misses': misses,
+                    'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+
+class LatestRequests:
+    '''Latest request per (session, output).
+
+    A callback takes a ticket for every output it computes. When a newer request of the
+    same session takes a ticket for that output, the older ticket is superseded and the
+    work for it can be dropped, as only the newest result is ever shown.
+    '''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def issue(self, session, output):
+        '''New ticket superseding all earlier ones of the output. Requests without a
+        session id get None, which is never superseded.'''
+        if session is None:
+            return None
+        key = (session, output)
+        number = next(self._counter)
+        with self._lock:
+            self._latest[key] = number
+            self._latest.move_to_end(key)
+            while len(self._latest) > self.maxsize:
+                self._latest.popitem(last=False)
+        return key, number
+
+    def superseded(self, tickets):
+        '''True when every one of the tickets has been superseded.'''
+        tickets = [t for t in tickets if t is not None]
+        return bool(tickets) and all(self._latest.get(key, number) != number for key, number in tickets)
+
+    def cancelled(self):
+        '''Progress handler of ConnectionPool: abort queries of superseded callbacks.'''
+        return self.superseded(current_tickets.get())
+
+    @contextmanager
+    def running(self, tickets):
+        '''Run the block on behalf of the tickets, i.e. queries in it are aborted once
+        all of them are superseded.'''
+        token = current_tickets.set(tuple(tickets))
+        try:
+            yield
+        finally:
+            current_tickets.reset(token)
+
+
+class FetchPool:
+    '''A few threads running independent fetches of one request side by side.
+
+    Work is only handed to a pool thread while one is free, otherwise it runs in the
+    calling thread, so a busy worker never runs more than its serving threads plus
+    `max_workers` fetches at once. Tasks run in a copy of the caller's context (the tickets
+    of LatestRequests, Server-Timing steps, ...) and use the ConnectionPool connections of
+    their thread. Threads are only started on first use, i.e. in each forked worker.
+    '''
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self.runs = Counter()
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # threads of a pool started before a fork do not exist in the child
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='fetch')
+                self._slots = threading.BoundedSemaphore(self.max_workers)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    @staticmethod
+    def _run(slots, context, func, item):
+        try:
+            return context.run(func, item)
+        finally:
+            slots.release()
+
+    def map(self, func, items):
+        '''[func(item) for item in items], computed side by side as far as threads are free.
+        The last item always runs in the calling thread.'''
+        items = list(items)
+        if len(items) < 2 or self.max_workers < 1:
+            return [func(item) for item in items]
+        executor, slots = self._pool()
+        futures = {}
+        for i, item in enumerate(items[:-1]):
+            if slots.acquire(blocking=False):
+                futures[i] = executor.submit(self._run, slots, contextvars.copy_context(), func, item)
+        with self._lock:
+            self.runs['pool'] += len(futures)
+            self.runs['inline'] += len(items) - len(futures)
+        results = {i: func(item) for i, item in enumerate(items) if i not in futures}
+        for i, future in futures.items():
+            results[i] = future.result()
+        return [results[i] for i in range(len(items))]
+
+
+class CacheWarmer:
+    '''Background thread filling a QueryCache while the server is idle.
+
+    `jobs` returns (memoized helper, args) pairs that are computed first, in order. Then
+    the most requested calls (QueryCache.hot_calls) follow. The pending jobs are
+    checked again every `interval` seconds, so a refreshed database is warmed up again.
+    The thread runs at the lowest CPU priority and only works when no request has been
+    served for `idle_seconds`.
+    '''
+
+    def __init__(self, cache, jobs, n_hot=100, idle_seconds=1.0, interval=30.0):
+        self.cache = cache
+        self.jobs = jobs
+        self.n_hot = n_hot
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.state = 'not started'
+        self.computed = 0
+        self.failed = 0
+        self.pending = 0
+        self._active = 0
+        self._last_request = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+                self._thread.start()
+
+    def request_started(self):
+        with self._lock:
+            self._active += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._active -= 1
+            self._last_request = time.monotonic()
+
+    def _idle(self):
+        return self._active == 0 and time.monotonic() - self._last_request >= self.idle_seconds
+
+    def _pending_jobs(self, fixed):
+        jobs, seen = [], set()
+        for func, args in fixed + self.cache.hot_calls(self.n_hot):
+            key = QueryCache._key(getattr(func, 'uncached', func), args)
+            if key not in seen and not self.cache.contains(func, *args):
+                seen.add(key)
+                jobs.append((func, args))
+        return jobs
+
+    def _run(self):
+        try:
+            # Linux applies the nice value to this thread only
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        fixed = None
+        while True:
+            try:
+                if fixed is None:
+                    fixed = list(self.jobs())
+                jobs = self._pending_jobs(fixed)
+            except Exception as e:
+                print(f'Cache warmer: {e!r}', flush=True)
+                jobs = []
+            self.pending = len(jobs)
+            if jobs:
+                print(f'Cache warmer: computing {len(jobs)} results', flush=True)
+                started = time.monotonic()
+                for func, args in jobs:
+                    while not self._idle():
+                        self.state = 'waiting'
+                        time.sleep(0.1)
+                    self.state = 'warming'
+                    try:
+                        self.computed += self.cache.warm(func, *args)
+                    except Exception as e:
+                        self.failed += 1
+                        print(f'Cache warmer: {func.__name__}{args} failed: {e!r}', flush=True)
+                    self.pending -= 1
+                print(f'Cache warmer: done in {time.monotonic() - started:.1f} s, '
+                      f'{self.computed} computed, {self.failed} failed since start', flush=True)
+            self.state = 'idle'
+            time.sleep(self.interval)
+
+    def status(self):
+        return {'state': self.state, 'pending': self.pending, 'computed': self.computed, 'failed': self.failed}
@@ -0,0 +1,344 @@
+'''Command-line tools for preparing the dashboard database.
+
+The raw data.db produced by the bibliometrics_NMR_data_prep repository only contains
+the `publications` table. Before it is served by app.py it has to be compiled, i.e.
+extended with precomputed tables that the dashboard reads instead of scanning
+`publications` on every click:
+
+    python dbtools.py compile /var/data/data.db
+    python dbtools.py compile raw.db -o /var/data/data.db
+
+Before a refreshed database goes live, check that every dashboard query still uses
+the intended indexes:
+
+    python dbtools.py explain /var/data/data.db
+
+app.py never inspects or writes the database at import. `check` is run once before the
+workers start (see gunicorn.conf.py) and exits with an error for a database the dashboard
+cannot serve:
+
+    python dbtools.py check /var/data/data.db
+
+With several gunicorn workers, export the per-paper columns once more as a memory-mapped
+snapshot (see columnar.py) that all workers share instead of each caching query results:
+
+    python dbtools.py export-columns /var/data/data.db     # -> /var/data/data.columns/
+'''
+
+import argparse
+import sqlite3
+import sys
+from collections import Counter
+from pathlib import Path
+
+import queries
+from columnar import ColumnarSnapshot, export_columns, snapshot_directory
+
+
+# Bump whenever the layout of the compiled tables changes. The dashboard refuses to start
+# on a database stamped with a different version (see check_database).
+SCHEMA_VERSION = 6
+
+
+#########################################
+### DERIVED TABLES ###
+#########################################
+
+def build_country_year_summary(conn):
+    '''Per (majority_country, year) counts and sums used by the per-year plots.
+    Non-NULL counts are kept next to the sums so that averages match AVG() on the raw table.'''
+    conn.execute('DROP TABLE IF EXISTS country_year_summary')
+    conn.execute('''CREATE TABLE country_year_summary (
+                        majority_country TEXT NOT NULL,
+                        year_pubmed INTEGER NOT NULL,
+                        n_papers INTEGER NOT NULL,
+                        n_open_access INTEGER,
+                        n_open_access_known INTEGER NOT NULL,
+                        sum_authors INTEGER,
+                        n_authors_known INTEGER NOT NULL,
+                        sum_references INTEGER,
+                        n_references_known INTEGER NOT NULL,
+                        sum_citations INTEGER NOT NULL,
+                        PRIMARY KEY (majority_country, year_pubmed)
+                    ) WITHOUT ROWID''')
+    conn.execute('''INSERT INTO country_year_summary
+                    SELECT majority_country, year_pubmed,
+                           COUNT(*),
+                           SUM(is_open_access), COUNT(is_open_access),
+                           SUM(authors_number), COUNT(authors_number),
+                           SUM(n_references), COUNT(n_references),
+                           COALESCE(SUM(cited_by_count), 0)
+                    FROM publications
+                    WHERE majority_country IS NOT NULL AND year_pubmed IS NOT NULL
+                    GROUP BY majority_country, year_pubmed''')
+
+
+def parse_countries(x):
+    '''"['US', 'US', 'DE']" -> ['US', 'US', 'DE']'''
+    return list(filter(None, x.replace("[", "")\
+                              .replace("]", "")\
+                              .replace("'", "")\
+                              .replace(" ", "")\
+                              .split(',')))
+
+
+def build_affiliations(conn):
+    '''One row per (paper, affiliation country) with the number of affiliations of the paper
+    in that country, so that collaboration statistics can be aggregated with GROUP BY
+    instead of parsing the `countries` lists at request time.'''
+    conn.execute('DROP TABLE IF EXISTS affiliations')
+    conn.execute('''CREATE TABLE affiliations (
+                        majority_country TEXT NOT NULL,
+                        year_pubmed INTEGER NOT NULL,
+                        affiliation_country TEXT NOT NULL,
+                        pmid INTEGER NOT NULL,
+                        n_affiliations INTEGER NOT NULL,
+                        PRIMARY KEY (majority_country, year_pubmed, affiliation_country, pmid)
+                    ) WITHOUT ROWID''')
+
+    def rows():
+        papers = conn.execute('''SELECT pmid, year_pubmed, majority_country, countries FROM publications
+                                 WHERE countries IS NOT NULL
+                                 AND majority_country IS NOT NULL AND year_pubmed IS NOT NULL''')
+        for pmid, year, majority_country, countries in papers:
+            for affiliation_country, n in Counter(parse_countries(countries)).items():
+                yield majority_country, year, affiliation_country, pmid, n
+
+    conn.executemany('''INSERT INTO affiliations VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT DO UPDATE SET n_affiliations = n_affiliations + excluded.n_affiliations''',
+                     rows())
+
+
+def build_journal_counts(conn):
+    '''Journals with an id, and the number of papers per (majority_country, year, journal id),
+    from which the journals ranking of any year range is summed (see aggregates.GroupedYearSums).
+    Abbreviations with the same title share one id, so the ranking has one bar per title.
+    Ids follow the journal titles, so that equal counts are ranked alphabetically.'''
+    conn.execute('DROP TABLE IF EXISTS journal_counts')
+    conn.execute('DROP TABLE IF EXISTS journals')
+    # one title per journal abbreviation, the abbreviation itself if it has none
+    conn.execute('''CREATE TEMP TABLE journal_abbreviations AS
+                    SELECT journal, COALESCE(MIN(journal_title), journal) AS journal_title FROM publications
+                    WHERE journal IS NOT NULL
+                    GROUP BY journal''')
+    conn.execute('''CREATE TABLE journals (
+                        journal_id INTEGER PRIMARY KEY,
+                        journal_title TEXT NOT NULL UNIQUE
+                    )''')
+    conn.execute('''INSERT INTO journals (journal_title)
+                    SELECT DISTINCT journal_title FROM journal_abbreviations
+                    ORDER BY journal_title''')
+    conn.execute('''CREATE TABLE journal_counts (
+                        majority_country TEXT NOT NULL,
+                        year_pubmed INTEGER NOT NULL,
+                        journal_id INTEGER NOT NULL REFERENCES journals,
+                        n_papers INTEGER NOT NULL,
+                        PRIMARY KEY (majority_country, year_pubmed, journal_id)
+                    ) WITHOUT ROWID''')
+    # joined ON, not USING (journal_title): publications has a journal_title of its own
+    conn.execute('''INSERT INTO journal_counts
+                    SELECT majority_country, year_pubmed, journal_id, COUNT(*)
+                    FROM publications p
+                    JOIN journal_abbreviations a ON a.journal = p.journal
+                    JOIN journals j ON j.journal_title = a.journal_title
+                    WHERE majority_country IS NOT NULL AND year_pubmed IS NOT NULL
+                    GROUP BY majority_country, year_pubmed, journal_id''')
+    conn.execute('DROP TABLE journal_abbreviations')
+
+
+# Length of the per-year lists in top_cited. Deeper rankings are queried from `publications`.
+TOP_CITED_DEPTH = 10
+
+
+def build_top_cited(conn):
+    '''The TOP_CITED_DEPTH most cited articles of every (majority_country, year), from which
+    the top articles of any year range are merged (see aggregates.YearTopLists).
+    Ties are broken by pmid, as in queries.TOP_CITED_PAPERS.'''
+    conn.execute('DROP TABLE IF EXISTS top_cited')
+    conn.execute('''CREATE TABLE top_cited (
+                        majority_country TEXT NOT NULL,
+                        year_pubmed INTEGER NOT NULL,
+                        rank INTEGER NOT NULL,
+                        pmid INTEGER,
+                        title_pubmed TEXT,
+                        cit_per_year REAL,
+                        PRIMARY KEY (majority_country, year_pubmed, rank)
+                    ) WITHOUT ROWID''')
+    conn.execute('''INSERT INTO top_cited
+                    SELECT majority_country, year_pubmed, rank, pmid, title_pubmed, cit_per_year
+                    FROM (SELECT majority_country, year_pubmed, pmid, title_pubmed, cit_per_year,
+                                 ROW_NUMBER() OVER (PARTITION BY majority_country, year_pubmed
+                                                    ORDER BY cit_per_year DESC, pmid) AS rank
+                          FROM publications
+                          WHERE majority_country IS NOT NULL AND year_pubmed IS NOT NULL)
+                    WHERE rank <= :depth''', dict(depth=TOP_CITED_DEPTH))
+
+
+# Indexes on `publications` matching the shapes of the dashboard queries in queries.py.
+# Any other idx_* index on `publications` is dropped by compile.
+INDEXES = {
+    # most cited articles, covering the selected columns
+    'idx_country_year_cit': 'publications(majority_country, year_pubmed, cit_per_year, pmid, title_pubmed)',
+}
+
+
+def build_indexes(conn):
+    existing = [name for (name,) in conn.execute("""SELECT name FROM sqlite_master
+                                                   WHERE type = 'index' AND tbl_name = 'publications'
+                                                   AND name LIKE 'idx\\_%' ESCAPE '\\'""")]
+    for name in existing:
+        if name not in INDEXES:
+            conn.execute(f'DROP INDEX {name}')
+    for name, columns in INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {columns}')
+
+
+BUILD_STEPS = [
+    build_country_year_summary,
+    build_affiliations,
+    build_top_cited,
+    build_journal_counts,
+    build_indexes,
+]
+
+
+#########################################
+### COMMANDS ###
+#########################################
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def compile_db(db_file, output=None):
+    '''Build all derived tables and stamp the schema version. With `output` the raw
+    database is copied first and left untouched.'''
+    conn = sqlite3.connect(db_file)
+    if output:
+        target = sqlite3.connect(output)
+        conn.backup(target)
+        conn.close()
+        conn = target
+
+    with conn:
+        for step in BUILD_STEPS:
+            print(f'{step.__name__}...', flush=True)
+            step(conn)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.execute('VACUUM')
+    # planner statistics for the new tables and indexes
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f'Compiled {output or db_file} (schema version {SCHEMA_VERSION})')
+
+
+def check_database(db_file):
+    '''Problems that keep the dashboard from serving db_file, an empty list if there are none.
+    A stale columnar snapshot is only reported, the app falls back to SQLite.'''
+    if not Path(db_file).is_file():
+        return [f'{db_file} not found']
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    try:
+        version = schema_version(conn)
+        if version != SCHEMA_VERSION:
+            return [f'{db_file} is compiled for schema version {version}, not {SCHEMA_VERSION}, '
+                    f'run: python dbtools.py compile {db_file}']
+        # prints a warning for a stale snapshot
+        ColumnarSnapshot.open(snapshot_directory(db_file), conn)
+    finally:
+        conn.close()
+    return []
+
+
+def export_snapshot(db_file, directory=None):
+    '''Write the columnar snapshot of a compiled database, by default next to it.'''
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    if schema_version(conn) != SCHEMA_VERSION:
+        raise SystemExit(f'{db_file} is not compiled for schema version {SCHEMA_VERSION}, '
+                         f'run: python dbtools.py compile {db_file}')
+    directory = directory or snapshot_directory(db_file)
+    n_rows = export_columns(conn, directory)
+    conn.close()
+    print(f'Exported {n_rows} papers to {directory}')
+
+
+def plan_problems(name, plan):
+    '''Steps of an EXPLAIN QUERY PLAN output that indicate a full table scan, an
+    unexpected temp B-tree or a query no longer using its index.'''
+    problems = []
+    index = queries.EXPECTED_INDEXES.get(name)
+    if index and not any(f'INDEX {index} ' in detail or detail.endswith(f'INDEX {index}') for detail in plan):
+        problems.append(f'{index} not used')
+    for detail in plan:
+        if detail.startswith('SCAN ') and 'INDEX' not in detail:
+            problems.append(f'full table scan: {detail}')
+        elif detail.startswith('USE TEMP B-TREE FOR '):
+            clause = detail[len('USE TEMP B-TREE FOR '):]
+            if not any(clause.startswith(x) for x in queries.EXPECTED_TEMP_BTREES.get(name, ())):
+                problems.append(f'temp b-tree: {detail}')
+    return problems
+
+
+def explain(db_file, country=None, year_range=(2000, 2024), min_papers=100):
+    '''Print the query plan of every dashboard query and return the number of queries
+    with plan problems.'''
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    if country is None:
+        # plans are checked for the biggest producer, i.e. the slowest panels
+        country = conn.execute(queries.TOP_COUNTRIES, dict(n=1)).fetchone()[0]
+    params = dict(country=country, year_start=year_range[0], year_end=year_range[1], min_papers=min_papers,
+                  k=TOP_CITED_DEPTH + 1)
+
+    n_bad = 0
+    for name, sql in queries.DASHBOARD_QUERIES.items():
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        problems = plan_problems(name, plan)
+        n_bad += bool(problems)
+        print(f'{"FLAG" if problems else "ok  "} {name}')
+        for detail in plan:
+            print(f'       {detail}')
+        for problem in problems:
+            print(f'    !! {problem}')
+    conn.close()
+    print(f'{n_bad} of {len(queries.DASHBOARD_QUERIES)} queries flagged (country={country})')
+    return n_bad
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prepare data.db for the NMR dashboard.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p_compile = commands.add_parser('compile', help='build precomputed tables')
+    p_compile.add_argument('db_file', help='path to data.db')
+    p_compile.add_argument('-o', '--output', help='write the compiled database here instead of in place')
+
+    p_explain = commands.add_parser('explain', help='check query plans of all dashboard queries')
+    p_explain.add_argument('db_file', help='path to data.db')
+    p_explain.add_argument('--country', help='country code used in the queries (default: largest producer)')
+
+    p_check = commands.add_parser('check', help='check that the dashboard can serve the database')
+    p_check.add_argument('db_file', help='path to data.db')
+
+    p_export = commands.add_parser('export-columns', help='write the memory-mapped columnar snapshot')
+    p_export.add_argument('db_file', help='path to the compiled data.db')
+    p_export.add_argument('-d', '--directory', help='output directory (default: data.columns next to data.db)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compile':
+        compile_db(args.db_file, args.output)
+    elif args.command == 'explain':
+        return 1 if explain(args.db_file, args.country) else 0
+    elif args.command == 'check':
+        problems = check_database(args.db_file)
+        for problem in problems:
+            print(problem)
+        if not problems:
+            print(f'{args.db_file} ok (schema version {SCHEMA_VERSION})')
+        return 1 if problems else 0
+    elif args.command == 'export-columns':
+        export_snapshot(args.db_file, args.directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
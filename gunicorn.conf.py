@@ -0,0 +1,50 @@
+'''Gunicorn settings for serving the dashboard with several worker processes:
+
+    gunicorn app:server              # picks up this file from the working directory
+    WEB_CONCURRENCY=8 gunicorn app:server
+
+The app is imported once in the master (preload_app) and the workers are forked from it,
+sharing the loaded maps. The database is checked, and the in-memory tables built from it
+are loaded, once before any worker starts; every worker opens its own read-only
+connections after the fork.
+'''
+
+import gc
+import multiprocessing
+import os
+import time
+
+
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+
+# one worker per core unless set, each serving GUNICORN_THREADS callbacks at a time
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 180
+
+# import app.py (and read the map files) once, before forking the workers
+preload_app = True
+
+
+def on_starting(server):
+    from app import DB_FILE, load_tables
+    from dbtools import check_database
+
+    problems = check_database(DB_FILE)
+    if problems:
+        # stops the master before any worker is started
+        raise SystemExit('\n'.join(problems))
+
+    started = time.monotonic()
+    load_tables()
+    # objects that exist now are never visited by the workers' garbage collector, which
+    # would otherwise touch (and so copy) the pages of the shared tables
+    gc.freeze()
+    server.log.info(f'{DB_FILE} ok, tables loaded in {time.monotonic() - started:.1f} s, '
+                    f'starting {workers} workers x {threads} threads')
+
+
+def post_fork(server, worker):
+    from app import after_fork
+
+    after_fork(threads=server.cfg.threads)
@@ -0,0 +1,216 @@
+'''Prometheus metrics of the dashboard, served as text by the /metrics route of app.py.
+
+Counters, gauges and histograms are kept in a Registry and rendered in the Prometheus
+text exposition format, without a client library. Values that other objects keep anyway
+(e.g. the hit counts of the QueryCache) are read by collectors when the page is rendered.
+
+Every gunicorn worker keeps its own metrics, labelled with its pid, so that the series of
+different workers do not overwrite each other when a scrape reaches another worker.
+
+Durations of the steps of one request (query helpers, plots) are also collected with
+record_timing and returned to the browser in a Server-Timing header, see app.py.
+'''
+
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# seconds, from cached answers to slow queries on the largest producers
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# callback responses, from a patched year range to a full figure with many countries
+SIZE_BUCKETS = (1e3, 3e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {self.labelnames}, not {tuple(labels)}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        '''(suffix, labels, value) of every series'''
+        with self._lock:
+            return [('', key, value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        '''Observe the seconds spent in the with block, also when it raises.'''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(('_bucket', key + (('le', format_value(bound)),), count))
+                samples.append(('_sum', key, total))
+                samples.append(('_count', key, counts[-1]))
+        return samples
+
+
+class Collected(Metric):
+    '''Series read from collect() at every render, e.g. {(('helper', name),): hits}.'''
+
+    def __init__(self, name, help, type, collect):
+        super().__init__(name, help)
+        self.type = type
+        self.collect = collect
+
+    def samples(self):
+        return [('', key, value) for key, value in self.collect().items()]
+
+
+class Registry:
+    def __init__(self, **const_labels):
+        self.const_labels = tuple(const_labels.items())
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collected(self, name, help, type, collect):
+        return self._add(Collected(name, help, type, collect))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(self.const_labels + labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# the exposition format version served by /metrics
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = Registry(pid=os.getpid())
+
+
+def reset_after_fork():
+    # a forked worker starts with empty metrics of its own pid
+    registry.const_labels = (('pid', os.getpid()),)
+    for metric in registry.metrics:
+        with metric._lock:
+            metric._values.clear()
+
+
+#########################################
+### SERVER-TIMING ###
+#########################################
+
+# [(name, seconds)] of the steps of the request handled in the current context
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def record_timing(name, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def timed(histogram, step, **labels):
+    '''Observe the seconds spent in the with block in histogram, and as a Server-Timing step.'''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        histogram.observe(seconds, **labels)
+        record_timing(step, seconds)
+
+
+def server_timing(timings, total):
+    '''Server-Timing header value: the total, then every step (summed per name) in order.'''
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0) + seconds
+    entries = [('total', total)] + list(durations.items())
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in entries)
@@ -0,0 +1,151 @@
+'''SQL run by the dashboard.
+
+The queries live here rather than inline in app.py so that `python dbtools.py explain`
+checks the plans of exactly the statements the dashboard executes. Values are always
+bound as named parameters (:country, :year_start, :year_end, :min_papers), never
+formatted into the SQL, so every query stays a constant string that SQLite's
+statement cache can reuse.
+'''
+
+#########################################
+### COUNTRY PLOTS ###
+#########################################
+
+PUBS_PER_YEAR = """
+    SELECT year_pubmed as Year, n_papers as 'Articles' FROM country_year_summary
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    ORDER BY year_pubmed DESC"""
+
+OPEN_ACCESS_PER_YEAR = """
+    SELECT year_pubmed as Year, ROUND(CAST(n_open_access AS FLOAT)*100 / n_open_access_known,1) as 'Open access'
+    FROM country_year_summary
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    ORDER BY year_pubmed DESC"""
+
+AUTHORS_PER_YEAR = """
+    SELECT year_pubmed as Year, ROUND(CAST(sum_authors AS FLOAT) / n_authors_known,2) as 'Average number of authors'
+    FROM country_year_summary
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    ORDER BY year_pubmed DESC"""
+
+# citations summed over papers divided by the summed years since publication (as of 2025)
+AACR_PER_YEAR = """
+    SELECT year_pubmed as 'Publication year', sum_citations AS citations,
+           n_papers * (2025 - year_pubmed) AS Years_duration,
+           CAST(sum_citations AS FLOAT) / (n_papers * (2025 - year_pubmed)) AS 'Average annual citation rate'
+    FROM country_year_summary
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    ORDER BY year_pubmed"""
+
+REFERENCES_PER_YEAR = """
+    SELECT year_pubmed as Year, ROUND(CAST(sum_references AS FLOAT) / n_references_known,2) as 'Average number of references'
+    FROM country_year_summary
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    ORDER BY year_pubmed DESC"""
+
+FOREIGN_AFFILIATIONS_PER_YEAR = """
+    SELECT year_pubmed as Year,
+           ROUND(100.0*SUM(CASE WHEN affiliation_country = :country THEN n_affiliations ELSE 0 END)
+                 / SUM(n_affiliations),2) AS 'Home affiliations'
+    FROM affiliations
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    GROUP BY year_pubmed
+    ORDER BY year_pubmed DESC"""
+
+# every year of the country, a year without foreign affiliations as one row with NULL country
+FOREIGN_COUNTRIES_PER_YEAR = """
+    SELECT s.year_pubmed as Year, a.affiliation_country AS country, SUM(a.n_affiliations) AS n
+    FROM country_year_summary s
+    LEFT JOIN affiliations a
+    ON a.majority_country = s.majority_country AND a.year_pubmed = s.year_pubmed
+    AND a.affiliation_country != :country
+    WHERE s.majority_country = :country
+    AND s.year_pubmed BETWEEN :year_start AND :year_end
+    GROUP BY s.year_pubmed, a.affiliation_country
+    ORDER BY s.year_pubmed DESC, n DESC"""
+
+# papers per country, journal and year, kept in memory for the journals ranking
+JOURNAL_COUNTS = """
+    SELECT majority_country, journal_id, year_pubmed, n_papers
+    FROM journal_counts"""
+
+JOURNAL_TITLES = """
+    SELECT journal_id, journal_title FROM journals"""
+
+# only used for rankings deeper than the precomputed top_cited lists (see dbtools.py)
+TOP_CITED_PAPERS = """
+    SELECT title_pubmed AS Title, cit_per_year AS 'Annual citation rate', pmid as PMID, year_pubmed as 'Year'
+    FROM publications
+    WHERE majority_country = :country
+    AND year_pubmed BETWEEN :year_start AND :year_end
+    ORDER BY cit_per_year DESC, pmid
+    LIMIT :k"""
+
+# per-year lists merged by top_cited_papers
+TOP_CITED_LISTS = """
+    SELECT majority_country, year_pubmed, title_pubmed, cit_per_year, pmid
+    FROM top_cited
+    ORDER BY majority_country, year_pubmed, rank"""
+
+
+#########################################
+### MAP ###
+#########################################
+
+# foreign affiliations of every country per partner and year, kept in memory for the
+# collaborators map, see aggregates.GroupedYearSums
+CO_AFFILIATIONS = """
+    SELECT majority_country, affiliation_country, year_pubmed, SUM(n_affiliations)
+    FROM affiliations
+    WHERE affiliation_country != majority_country
+    GROUP BY majority_country, affiliation_country, year_pubmed"""
+
+# map metrics are computed from this table in memory, see aggregates.py
+COUNTRY_YEAR_SUMMARY = """
+    SELECT majority_country, year_pubmed, n_papers, n_open_access, n_open_access_known,
+           sum_authors, n_authors_known, sum_references, n_references_known, sum_citations
+    FROM country_year_summary"""
+
+
+# largest producers, warmed up first after a start (not a dashboard query, so not plan-checked)
+TOP_COUNTRIES = """
+    SELECT majority_country FROM country_year_summary
+    WHERE majority_country != 'Multinational'
+    GROUP BY majority_country
+    ORDER BY SUM(n_papers) DESC
+    LIMIT :n"""
+
+
+#########################################
+### PLAN CHECKS ###
+#########################################
+
+# query helper in app.py -> SQL, checked by `python dbtools.py explain`
+DASHBOARD_QUERIES = {
+    'get_pubs_per_year_per_country': PUBS_PER_YEAR,
+    'openacces_per_year_per_country': OPEN_ACCESS_PER_YEAR,
+    'av_authors_per_year_per_country': AUTHORS_PER_YEAR,
+    'aacr_per_year_per_country': AACR_PER_YEAR,
+    'references_per_year_per_country': REFERENCES_PER_YEAR,
+    'foreign_collaborators_perc': FOREIGN_AFFILIATIONS_PER_YEAR,
+    'each_foreign_collaborator_perc': FOREIGN_COUNTRIES_PER_YEAR,
+    'top_cited_papers': TOP_CITED_PAPERS,
+}
+
+# Temp B-trees accepted for the current query shapes, e.g. ordering an aggregated result
+# by a computed column. Any other temp B-tree or full table scan is reported as a plan regression.
+EXPECTED_TEMP_BTREES = {
+    'each_foreign_collaborator_perc': {'ORDER BY'},
+    'top_cited_papers': {'ORDER BY'},
+}
+
+# Queries on `publications` and the index (see dbtools.INDEXES) they are expected to use
+EXPECTED_INDEXES = {
+    'top_cited_papers': 'idx_country_year_cit',
+}